@@ -0,0 +1,72 @@
+"""Benchmark of FIT file size and encoding time per device_info mode
+
+Encodes daily weigh-ins into a weight FIT file once per --fit-device-info
+mode and prints the file size and the best encoding time:
+
+    python benchmarks/fit_size.py --days 3650 --repeat 5
+
+The measurements come from two scales, the second one used from half
+way through, so that 'changed' writes a device_info record twice."""
+import argparse
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+DEVICE_INFO_MODES = ("every", "once", "changed")
+
+
+def get_args():
+    """Parse the benchmark options"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--days", type=int, default=3650, help="Number of daily weigh-ins to encode."
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs per mode, the best is shown."
+    )
+    return parser.parse_args()
+
+
+def make_records(days):
+    """Weight records of one weigh-in a day"""
+    start = datetime(2015, 1, 1, 7, 30)
+    return [
+        {
+            "date_time": start + timedelta(days=i),
+            "type": "weight",
+            "weight": 70 + (i % 50) / 10,
+            "fat_ratio": 18.5,
+            "percent_hydration": 55.2,
+            "bone_mass": 3.1,
+            "muscle_mass": 32.4,
+            "bmi": 22.1,
+            "device_id": "scale1" if i < days // 2 else "scale2",
+        }
+        for i in range(days)
+    ]
+
+
+def main():
+    """Run the benchmark"""
+    args = get_args()
+    # sync reads its settings from the command line on import
+    sys.argv = ["withings-sync"]
+    # pylint: disable=import-outside-toplevel
+    from withings_sync.sync import iter_fitshards
+
+    logging.basicConfig(level=logging.WARNING)
+    records = make_records(args.days)
+    for mode in DEVICE_INFO_MODES:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            shards = list(iter_fitshards(records, device_info=mode))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        size = sum(shard.fit.get_size() for shard in shards)
+        print(f"{mode:8s} {size:9d} bytes {best * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Benchmark of the memory held by fetched measurement groups
+
+Parses a generated getmeas payload like the fetch does, keeps the
+WithingsMeasureGroup objects and drops the parsed JSON, then prints the
+memory still allocated and the peak, as traced by tracemalloc:
+
+    python benchmarks/memory.py --groups 100000"""
+import argparse
+import json
+import tracemalloc
+
+from withings_sync.withings2 import WithingsMeasureGroup
+
+
+def get_args():
+    """Parse the benchmark options"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--groups",
+        type=int,
+        default=100000,
+        help="Number of measurement groups to keep.",
+    )
+    return parser.parse_args()
+
+
+def make_payload(count):
+    """A getmeas payload of count groups with five measures each"""
+    date = 1700000000
+    measures = [(6, -1, 200), (77, -2, 3000), (76, -2, 3000), (88, -2, 300)]
+    return json.dumps(
+        [
+            {
+                "grpid": i,
+                "attrib": 0,
+                "date": date + i * 3600,
+                "created": date + i * 3600,
+                "modified": date + i * 3600,
+                "category": 1,
+                "deviceid": "abcdef0123456789",
+                "hash_deviceid": "abcdef0123456789",
+                "comment": None,
+                "timezone": "Europe/Berlin",
+                "measures": [{"value": 70000 + i % 500, "type": 1, "unit": -3, "algo": 0, "fm": 3}]
+                + [
+                    {"value": value, "type": mtype, "unit": unit, "algo": 0, "fm": 3}
+                    for mtype, unit, value in measures
+                ],
+            }
+            for i in range(count)
+        ]
+    )
+
+
+def main():
+    """Run the benchmark"""
+    args = get_args()
+    payload = make_payload(args.groups)
+    tracemalloc.start()
+    groups = [WithingsMeasureGroup(group) for group in json.loads(payload)]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{len(groups)} groups: retained {current / 2**20:.1f} MB, "
+        f"peak {peak / 2**20:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
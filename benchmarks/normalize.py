@@ -0,0 +1,112 @@
+"""Benchmark of the normalization stage
+
+Iterates iter_syncdata over generated measurement groups and prints the
+best time of several repetitions per group count:
+
+    python benchmarks/normalize.py --groups 1000 10000 100000 --repeat 3
+
+The groups mix weight, body composition, blood pressure, height-only and
+pulse-only measurements, some sharing a timestamp with the previous one,
+so that merging is exercised as in a real account."""
+import argparse
+import gc
+import logging
+import random
+import sys
+import time
+
+
+def get_args():
+    """Parse the benchmark options"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--groups",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Numbers of measurement groups to normalize.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per group count, the best is shown."
+    )
+    parser.add_argument(
+        "--blood-pressure",
+        action="store_true",
+        help="Normalize blood pressure measurements too.",
+    )
+    return parser.parse_args()
+
+
+def make_groups(count, group_class, seed=1):
+    """Generate count measurement groups in date order"""
+    rnd = random.Random(seed)
+    groups = []
+    date = 1500000000
+    for i in range(count):
+        # a step of 0 gives the same timestamp as the previous group
+        date += rnd.choice([0, 60, 3600, 86400])
+        kind = rnd.random()
+        if kind < 0.5:
+            measures = [{"value": 7000 + i % 500, "type": 1, "unit": -2}]
+            if rnd.random() < 0.5:
+                measures.append({"value": 200, "type": 6, "unit": -1})
+            if rnd.random() < 0.3:
+                measures.append({"value": 3000, "type": 77, "unit": -2})
+            if rnd.random() < 0.3:
+                measures.append({"value": 65, "type": 11, "unit": 0})
+        elif kind < 0.8:
+            measures = [
+                {"value": 80, "type": 9, "unit": 0},
+                {"value": 120, "type": 10, "unit": 0},
+                {"value": 60 + i % 9, "type": 11, "unit": 0},
+            ]
+        elif kind < 0.9:
+            measures = [{"value": 180, "type": 4, "unit": -2}]
+        else:
+            measures = [{"value": 55, "type": 11, "unit": 0}]
+        groups.append(
+            group_class(
+                {
+                    "grpid": i,
+                    "date": date,
+                    "modified": date,
+                    "category": 1,
+                    "attrib": 0,
+                    "deviceid": f"device{i % 3}",
+                    "measures": measures,
+                }
+            )
+        )
+    return groups
+
+
+def main():
+    """Run the benchmark"""
+    args = get_args()
+    # sync reads its settings from the command line on import
+    sys.argv = ["withings-sync"]
+    if args.blood_pressure:
+        sys.argv += ["--features", "BLOOD_PRESSURE"]
+    # pylint: disable=import-outside-toplevel
+    from withings_sync.sync import iter_syncdata
+    from withings_sync.withings2 import WithingsMeasureGroup
+
+    logging.basicConfig(level=logging.WARNING)
+    for count in args.groups:
+        groups = make_groups(count, WithingsMeasureGroup)
+        # keep the input out of the garbage collections
+        gc.collect()
+        gc.freeze()
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for _ in iter_syncdata(1.8, iter(groups)):
+                pass
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        gc.unfreeze()
+        print(f"{count:9d} groups {best:8.3f} s {best / count * 1e6:6.2f} us/group")
+
+
+if __name__ == "__main__":
+    main()
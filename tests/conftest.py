@@ -0,0 +1,21 @@
+"""Shared fixtures of the tests"""
+import sys
+from unittest import mock
+
+import pytest
+
+# sync parses the command line when it is imported
+with mock.patch.object(sys, "argv", ["withings-sync"]):
+    from withings_sync import sync
+
+
+@pytest.fixture
+def set_args(monkeypatch):
+    """Replace the command line sync runs with, e.g. set_args("--incremental")"""
+
+    def set_command_line(*argv):
+        monkeypatch.setattr(sys, "argv", ["withings-sync", *argv])
+        monkeypatch.setattr(sync, "ARGS", sync.get_args())
+        return sync.ARGS
+
+    return set_command_line
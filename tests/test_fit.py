@@ -0,0 +1,152 @@
+"""Tests of the FIT CRC-16 helpers and of FIT files encoded by sync"""
+import random
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+
+from withings_sync import sync
+from withings_sync.fit import FitDecodeError, FitDecoder, _calcCRC, crc16, crc16_combine
+from withings_sync.sync import FitVerificationError
+
+
+def reference_crc(data, crc=0):
+    """FIT CRC-16 computed one byte at a time"""
+    for byte in data:
+        crc = _calcCRC(crc, byte)
+    return crc
+
+
+def random_bytes(rng, size):
+    return bytes(rng.randrange(256) for _ in range(size))
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 14, 255, 256, 4097])
+def test_crc16_matches_reference(size):
+    data = random_bytes(random.Random(size), size)
+    assert crc16(data) == reference_crc(data)
+
+
+def test_crc16_continues_from_crc():
+    rng = random.Random(1)
+    head, tail = random_bytes(rng, 100), random_bytes(rng, 37)
+    assert crc16(tail, crc16(head)) == reference_crc(head + tail)
+
+
+def test_crc16_accepts_bytes_like():
+    data = random_bytes(random.Random(2), 64)
+    assert crc16(bytearray(data)) == crc16(memoryview(data)) == reference_crc(data)
+
+
+def test_crc16_of_data_and_its_crc_is_zero():
+    # how a reader checks the CRC at the end of a FIT file
+    data = random_bytes(random.Random(3), 200)
+    crc = crc16(data)
+    assert crc16(data + crc.to_bytes(2, "little")) == 0
+
+
+@pytest.mark.parametrize(
+    "len1, len2", [(0, 0), (0, 9), (9, 0), (1, 1), (14, 300), (1000, 4097)]
+)
+def test_crc16_combine_matches_reference(len1, len2):
+    rng = random.Random(len1 * 10000 + len2)
+    data1, data2 = random_bytes(rng, len1), random_bytes(rng, len2)
+    combined = crc16_combine(crc16(data1), crc16(data2), len(data2))
+    assert combined == reference_crc(data1 + data2)
+
+
+WEIGHT_RECORDS = [
+    {
+        "date_time": datetime(2024, 5, day, 7, 30),
+        "type": "weight",
+        "weight": 72.35 + day / 10,
+        "fat_ratio": 18.4,
+        "percent_hydration": 55.21,
+        "bone_mass": 3.1,
+        "muscle_mass": 32.45,
+        "bmi": 22.3,
+        "device_id": "scale",
+    }
+    for day in range(1, 4)
+] + [
+    {
+        "date_time": datetime(2024, 5, 4, 7, 30),
+        "type": "weight",
+        "weight": 72.0,
+        "fat_ratio": None,
+        "percent_hydration": None,
+        "bone_mass": None,
+        "muscle_mass": None,
+        "bmi": None,
+        "device_id": None,
+    }
+]
+BLOOD_PRESSURE_RECORDS = [
+    {
+        "date_time": datetime(2024, 5, day, 8, 0),
+        "type": "blood_pressure",
+        "diastolic_blood_pressure": 78 + day,
+        "systolic_blood_pressure": 121,
+        "heart_pulse": 61,
+        "device_id": "cuff",
+    }
+    for day in range(1, 3)
+]
+
+
+def encode(kind, records, device_info="every"):
+    return sync.encode_fitshard(kind, records, kind, None, device_info)
+
+
+def corrupted(shard, offset, value):
+    """The shard with the byte at offset of its FIT file replaced"""
+    data = bytearray(shard.fit.getvalue())
+    data[offset] = value
+    shard.fit.buf = BytesIO(bytes(data))
+    return shard
+
+
+@pytest.mark.parametrize("device_info", ["every", "once", "changed"])
+@pytest.mark.parametrize(
+    "kind, records",
+    [("weight", WEIGHT_RECORDS), ("blood_pressure", BLOOD_PRESSURE_RECORDS)],
+)
+def test_fit_round_trip(kind, records, device_info):
+    shard = encode(kind, records, device_info)
+    _, message, fit_fields, _ = sync.FIT_KINDS[kind]
+
+    messages = list(FitDecoder(shard.fit.getvalue()))
+    assert messages[0][0] == "file_id"
+    decoded = [fields for name, fields in messages if name == message.name]
+    assert len(decoded) == len(records)
+    for record, fields in zip(records, decoded):
+        assert fields["timestamp"] == record["date_time"]
+        for key, field in fit_fields.items():
+            assert fields[field] == pytest.approx(record[key], abs=0.01)
+    assert sync.verify_fitshard(shard) == []
+    assert list(sync.verify_fitshards([shard])) == [shard]
+
+
+def test_flipped_payload_byte_fails_verification():
+    shard = encode("weight", WEIGHT_RECORDS)
+    data = shard.fit.getvalue()
+    # a byte of the last weight record, before the CRC
+    offset = len(data) - 5
+    corrupted(shard, offset, data[offset] ^ 0x01)
+
+    with pytest.raises(FitVerificationError):
+        list(sync.verify_fitshards([shard]))
+
+
+def test_corrupted_header_size_fails_verification():
+    shard = corrupted(encode("blood_pressure", BLOOD_PRESSURE_RECORDS), 0, 13)
+
+    with pytest.raises(FitVerificationError):
+        list(sync.verify_fitshards([shard]))
+
+
+def test_decoder_detects_truncated_data():
+    data = encode("weight", WEIGHT_RECORDS).fit.getvalue()
+
+    with pytest.raises(FitDecodeError):
+        list(FitDecoder(data[:-10]))
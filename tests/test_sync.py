@@ -0,0 +1,233 @@
+"""Tests of the sync steps between fetching and uploading"""
+import threading
+from datetime import datetime
+
+import pytest
+
+from withings_sync import sync
+from withings_sync.fit import FitDecoder
+from withings_sync.withings2 import WithingsMeasureGroup
+
+
+class FakeWithings:
+    """The sync state calls of a WithingsAccount, kept in a dict"""
+
+    def __init__(self, last_modified, **config):
+        self.last_modified = last_modified
+        self.config = config
+
+    def get_lastweight_tr(self):
+        return self.config.get("last_weight_tr", 0)
+
+    def set_lastupdate_tr(self, lastupdate, lastweight=None):
+        self.config["last_update_tr"] = lastupdate
+        if lastweight is not None:
+            self.config["last_weight_tr"] = lastweight
+
+    def set_lastsync_tr(self, lastweight=None):
+        self.config["last_sync_tr"] = "now"
+        if lastweight is not None:
+            self.config["last_weight_tr"] = lastweight
+
+
+class FakeTrainerRoad:
+    weight = 70.0
+
+
+class FakeSessions:
+    def __init__(self, withings):
+        self.withings = withings
+        self.trainerroad = None
+
+    def get_trainerroad(self):
+        self.trainerroad = FakeTrainerRoad()
+        return self.trainerroad
+
+
+def weight(when, value):
+    return {"date_time": when, "type": "weight", "weight": value}
+
+
+def blood_pressure(when):
+    return {
+        "date_time": when,
+        "type": "blood_pressure",
+        "diastolic_blood_pressure": 80,
+        "systolic_blood_pressure": 120,
+        "heart_pulse": 60,
+    }
+
+
+def measure_groups():
+    """Weight, body composition and blood pressure groups, oldest first"""
+    groups = []
+    for day in range(6):
+        date = 1714550400 + day * 86400
+        groups.append(
+            {
+                "grpid": 3 * day,
+                "date": date,
+                "measures": [
+                    {"value": 7000 + day, "type": 1, "unit": -2},
+                ],
+            }
+        )
+        # same time as the weight, merged into its record
+        groups.append(
+            {
+                "grpid": 3 * day + 1,
+                "date": date,
+                "measures": [
+                    {"value": 2000, "type": 6, "unit": -2},
+                ],
+            }
+        )
+        groups.append(
+            {
+                "grpid": 3 * day + 2,
+                "date": date + 3600,
+                "measures": [
+                    {"value": 80, "type": 9, "unit": 0},
+                    {"value": 120, "type": 10, "unit": 0},
+                    {"value": 60, "type": 11, "unit": 0},
+                ],
+            }
+        )
+    return groups
+
+
+def normalized(groups):
+    return list(
+        sync.iter_syncdata(1.8, (WithingsMeasureGroup(group) for group in groups))
+    )
+
+
+def test_newest_first_groups_give_oldest_first_records(set_args):
+    set_args("--features", "BLOOD_PRESSURE")
+    oldest_first = normalized(measure_groups())
+    # Withings may page newest first, same-time groups stay adjacent
+    newest_first = normalized(measure_groups()[::-1])
+
+    times = [record["date_time"] for record in oldest_first]
+    assert times == sorted(times)
+    assert len(times) == 12
+    assert [record["date_time"] for record in newest_first] == times
+    for record, expected in zip(newest_first, oldest_first):
+        assert {k: v for k, v in record.items() if k != "raw_data"} == {
+            k: v for k, v in expected.items() if k != "raw_data"
+        }
+    assert list(sync.generate_jsondata(newest_first)) == [str(t) for t in times]
+
+    shards = {shard.kind: shard for shard in sync.iter_fitshards(newest_first)}
+    for kind, shard in shards.items():
+        message = sync.FIT_KINDS[kind][1].name
+        decoded = [
+            fields["timestamp"]
+            for name, fields in FitDecoder(shard.fit.getvalue())
+            if name == message
+        ]
+        assert decoded == [t for t, r in zip(times, oldest_first) if r["type"] == kind]
+
+
+@pytest.fixture
+def trainerroad_args(set_args):
+    return set_args("--incremental", "--tu", "user", "--tp", "secret")
+
+
+def test_blood_pressure_only_delta_advances_trainerroad(trainerroad_args):
+    withings = FakeWithings(last_modified=2000, last_update_tr=1000)
+    sessions = FakeSessions(withings)
+
+    syncdata = [blood_pressure(datetime(2024, 5, 1, 8))]
+    sync.update_trainerroad(sessions, syncdata, incremental=True, ranged=False)
+
+    assert sessions.trainerroad is None
+    assert withings.config["last_update_tr"] == 2000
+
+
+def test_edited_older_weight_is_not_sent(trainerroad_args):
+    sent = int(datetime(2024, 5, 2, 8).timestamp())
+    withings = FakeWithings(
+        last_modified=3000, last_update_tr=1000, last_weight_tr=sent
+    )
+    sessions = FakeSessions(withings)
+
+    syncdata = [weight(datetime(2024, 5, 1, 8), 80.0)]
+    sync.update_trainerroad(sessions, syncdata, incremental=True, ranged=False)
+
+    assert sessions.trainerroad is None
+    assert withings.config == {
+        "last_update_tr": 3000,
+        "last_weight_tr": sent,
+    }
+
+
+def test_newer_weight_is_sent(trainerroad_args):
+    withings = FakeWithings(last_modified=3000, last_weight_tr=0)
+    sessions = FakeSessions(withings)
+
+    measured = datetime(2024, 5, 3, 8)
+    syncdata = [weight(datetime(2024, 5, 1, 8), 80.0), weight(measured, 71.24)]
+    sync.update_trainerroad(sessions, syncdata, incremental=True, ranged=False)
+
+    assert sessions.trainerroad.weight == 71.2
+    assert withings.config["last_update_tr"] == 3000
+    assert withings.config["last_weight_tr"] == int(measured.timestamp())
+
+
+class StopAfter:
+    """threading.Event stand-in that records the waits and stops the daemon"""
+
+    def __init__(self, waits):
+        self.waits = waits
+        self.delays = []
+
+    def set(self):
+        self.waits = 0
+
+    def is_set(self):
+        return len(self.delays) >= self.waits
+
+    def wait(self, delay=None):
+        if delay is not None:
+            self.delays.append(delay)
+
+
+class FakeSyncSessions:
+    resets = 0
+
+    def __init__(self, config_folder):
+        self.lock = threading.Lock()
+
+    def reset(self):
+        FakeSyncSessions.resets += 1
+
+    def close(self):
+        pass
+
+
+def test_daemon_backs_off_after_a_failed_sync(set_args, monkeypatch):
+    set_args("--daemon", "--interval", "3600")
+    results = iter([sync.SYNC_FAILED, sync.SYNC_FAILED, sync.SYNC_NOTHING, 0])
+    stop = StopAfter(4)
+    monkeypatch.setattr(sync, "sync", lambda sessions: next(results))
+    monkeypatch.setattr(sync, "SyncSessions", FakeSyncSessions)
+    monkeypatch.setattr(sync.threading, "Event", lambda: stop)
+    monkeypatch.setattr(sync.signal, "signal", lambda *_: None)
+    monkeypatch.setattr(sync, "DAEMON_BACKOFF", 60)
+    FakeSyncSessions.resets = 0
+
+    sync.daemon()
+
+    first, second, nothing, synced = stop.delays
+    assert 30 <= first <= 60
+    assert 60 <= second <= 120
+    # nothing to sync is not a failure
+    assert nothing == synced == 3600
+    assert FakeSyncSessions.resets == 2
+
+
+@pytest.mark.parametrize("mode", [["--daemon"], ["--listen", "8080"]])
+def test_accounts_reject_daemon_modes(set_args, mode):
+    with pytest.raises(SystemExit):
+        set_args("--accounts", "accounts.json", *mode)
@@ -0,0 +1,115 @@
+"""Tests of the Withings notification receiver against local requests"""
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import pytest
+
+from withings_sync.webhook import NotificationReceiver, callback_url
+
+
+class Recorder:
+    """Notification handler remembering the windows it was called with"""
+
+    def __init__(self):
+        self.windows = []
+        self.called = threading.Event()
+
+    def __call__(self, startdate, enddate):
+        self.windows.append((startdate, enddate))
+        self.called.set()
+
+
+@pytest.fixture
+def recorder():
+    return Recorder()
+
+
+@pytest.fixture
+def make_receiver(recorder):
+    receivers = []
+
+    def make(**kwargs):
+        kwargs.setdefault("delay", 0.2)
+        kwargs.setdefault("max_delay", 5)
+        receiver = NotificationReceiver(recorder, host="127.0.0.1", port=0, **kwargs)
+        receiver.start()
+        receivers.append(receiver)
+        return receiver
+
+    yield make
+    for receiver in receivers:
+        if receiver.threads[0].is_alive():
+            receiver.stop()
+
+
+def post(receiver, fields, query=""):
+    """POST a notification like Withings does, return the status code"""
+    host, port = receiver.address
+    url = f"http://{host}:{port}/withings" + (f"?{query}" if query else "")
+    body = urllib.parse.urlencode(fields).encode() if isinstance(fields, dict) else fields
+    try:
+        with urllib.request.urlopen(url, data=body, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as ex:
+        return ex.code
+
+
+def notification(startdate, enddate):
+    return {"userid": 1, "appli": 1, "startdate": startdate, "enddate": enddate}
+
+
+def test_notifications_coalesce_into_one_sync(make_receiver, recorder):
+    receiver = make_receiver()
+    assert post(receiver, notification(1000, 2000)) == 200
+    assert post(receiver, notification(500, 1500)) == 200
+    assert post(receiver, notification(1800, 3000)) == 200
+
+    assert recorder.called.wait(5)
+    # a second sync would be due 0.2 s after the last notification
+    recorder.called.clear()
+    assert not recorder.called.wait(0.6)
+    assert recorder.windows == [(500, 3000)]
+
+
+def test_malformed_notification_is_rejected(make_receiver, recorder):
+    receiver = make_receiver()
+    assert post(receiver, {"userid": 1, "appli": 1}) == 400
+    assert post(receiver, notification("soon", 2000)) == 400
+    assert post(receiver, b"\xff\xfe") == 400
+
+    assert not recorder.called.wait(0.5)
+
+
+def test_token_is_required_when_set(make_receiver, recorder):
+    receiver = make_receiver(token="s3cret")
+    assert post(receiver, notification(1000, 2000)) == 403
+    assert post(receiver, notification(1000, 2000), query="token=wrong") == 403
+    assert not recorder.called.wait(0.5)
+
+    assert post(receiver, notification(1000, 2000), query="token=s3cret") == 200
+    assert recorder.called.wait(5)
+    assert recorder.windows == [(1000, 2000)]
+
+
+def test_callback_url_carries_the_token():
+    assert callback_url("https://example.org/withings") == "https://example.org/withings"
+    assert (
+        callback_url("https://example.org/withings", "a b")
+        == "https://example.org/withings?token=a+b"
+    )
+    assert (
+        callback_url("https://example.org/withings?user=1", "t")
+        == "https://example.org/withings?user=1&token=t"
+    )
+
+
+def test_stop_shuts_the_server_down(make_receiver):
+    receiver = make_receiver()
+    host, port = receiver.address
+    receiver.stop()
+
+    assert not any(thread.is_alive() for thread in receiver.threads)
+    with pytest.raises(OSError):
+        urllib.request.urlopen(f"http://{host}:{port}/withings", data=b"", timeout=2)
@@ -1,13 +1,20 @@
 from io import BytesIO
 from struct import pack
+from struct import Struct
 from struct import unpack
 from datetime import datetime
+from itertools import compress
+from itertools import repeat
+from itertools import zip_longest
 import time
 
 
+_CRC_NIBBLE_TABLE = (0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
+                     0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400)
+
+
 def _calcCRC(crc, byte):
-    table = [0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401,
-             0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400]
+    table = _CRC_NIBBLE_TABLE
     # compute checksum of lower four bits of byte
     tmp = table[crc & 0xF]
     crc = (crc >> 4) & 0x0FFF
@@ -19,6 +26,45 @@ def _calcCRC(crc, byte):
     return crc
 
 
+# CRC of every byte value, so the checksum advances a whole byte per lookup
+_CRC_TABLE = tuple(_calcCRC(0, byte) for byte in range(256))
+
+
+def crc16(data, crc=0):
+    """FIT CRC-16 of a bytes-like object, continuing from crc"""
+    table = _CRC_TABLE
+    for byte in memoryview(data).cast('B'):
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
+    return result
+
+
+def crc16_combine(crc1, crc2, len2):
+    """CRC of A + B from crc1 = CRC(A), crc2 = CRC(B) and the length of B
+
+    The FIT CRC starts at zero and is linear, so appending B shifts CRC(A)
+    through len2 zero bytes, which is done by squaring the one-byte operator."""
+    # operator advancing the CRC state by one zero byte, one column per bit
+    mat = [((1 << n) >> 8) ^ _CRC_TABLE[(1 << n) & 0xFF] for n in range(16)]
+    while len2:
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(mat, crc1)
+        len2 >>= 1
+        if len2:
+            mat = [_gf2_matrix_times(mat, col) for col in mat]
+    return crc1 ^ crc2
+
+
 class FitBaseType(object):
     """BaseType Definition
 
@@ -47,10 +93,12 @@ class FitBaseType(object):
         }
         return formats[basetype['#']]
 
+    INTEGER_TYPES = (1, 2, 3, 4, 5, 6, 10, 11, 12)
+
     @staticmethod
     def pack(basetype, value):
         """function to avoid DeprecationWarning"""
-        if basetype['#'] in (1, 2, 3, 4, 5, 6, 10, 11, 12):
+        if basetype['#'] in FitBaseType.INTEGER_TYPES:
             value = int(value)
         fmt = FitBaseType.get_format(basetype)
         return pack(fmt, value)
@@ -69,16 +117,118 @@ class Fit(object):
     }
 
 
+class FitMessage(object):
+    """Precompiled layout of a FIT message type
+
+    The definition message and the little-endian struct of the data message
+    are built once, so writing a record is a single struct pack."""
+
+    def __init__(self, name, lmsg_type, fields):
+        """fields is a sequence of (field number, field name, base type, scale)"""
+        self.name = name
+        self.lmsg_type = lmsg_type
+        self.fields = tuple(fields)
+        self.definition = b''.join([
+            pack('<B', (1 << 6) + lmsg_type),  # definition record header
+            pack('<BBHB', 0, 0, Fit.GMSG_NUMS[name], len(fields)),  # reserved, architecture(0: little endian)
+            b''.join(pack('<BBB', num, basetype['size'], basetype['field']) for num, _, basetype, _ in fields),
+        ])
+        self.struct = Struct('<B' + ''.join(FitBaseType.get_format(basetype) for _, _, basetype, _ in fields))
+        self.converters = tuple(
+            (basetype['invalid'], scale, basetype['#'] in FitBaseType.INTEGER_TYPES)
+            for _, _, basetype, scale in fields
+        )
+
+    def pack(self, values):
+        """pack one data message, values in field order"""
+        packed = []
+        for value, (invalid, scale, is_integer) in zip(values, self.converters):
+            if value is None:
+                # invalid value
+                value = invalid
+            elif scale is not None:
+                value *= scale
+            if is_integer:
+                value = int(value)
+            packed.append(value)
+        return self.struct.pack(self.lmsg_type, *packed)
+
+    def pack_columns(self, columns, count):
+        """pack count data messages from columns in field order
+
+        Columns can be any sequences (lists, array.array, NumPy arrays).
+        A missing column, None or NaN entries become the invalid value."""
+        converted = []
+        for column, (invalid, scale, is_integer) in zip_longest(columns, self.converters):
+            if column is None:
+                converted.append(repeat(invalid, count))
+                continue
+            if len(column) != count:
+                raise ValueError('Column of %d values for %d %s records' % (len(column), count, self.name))
+            if scale is None:
+                scale = 1
+            if is_integer:
+                # value != value is only true for NaN
+                column = [invalid if value is None or value != value else int(value * scale) for value in column]
+            else:
+                column = [invalid if value is None or value != value else value * scale for value in column]
+            converted.append(column)
+        pack = self.struct.pack
+        lmsg_type = self.lmsg_type
+        return [pack(lmsg_type, *row) for row in zip(*converted)]
+
+
 class FitEncoder(Fit):
     FILE_TYPE = 9
     LMSG_TYPE_FILE_INFO = 0
     LMSG_TYPE_FILE_CREATOR = 1
     LMSG_TYPE_DEVICE_INFO = 2
 
-    def __init__(self):
-        self.buf = BytesIO()
+    DEVICE_INFO_EVERY = 'every'
+    DEVICE_INFO_ONCE = 'once'
+    DEVICE_INFO_CHANGED = 'changed'
+    DEVICE_INFO_MODES = (DEVICE_INFO_EVERY, DEVICE_INFO_ONCE, DEVICE_INFO_CHANGED)
+
+    FILE_ID = FitMessage('file_id', LMSG_TYPE_FILE_INFO, [
+        (3, 'serial_number', FitBaseType.uint32z, None),
+        (4, 'time_created', FitBaseType.uint32, None),
+        (1, 'manufacturer', FitBaseType.uint16, None),
+        (2, 'product', FitBaseType.uint16, None),
+        (5, 'number', FitBaseType.uint16, None),
+        (0, 'type', FitBaseType.enum, None),
+    ])
+    FILE_CREATOR = FitMessage('file_creator', LMSG_TYPE_FILE_CREATOR, [
+        (0, 'software_version', FitBaseType.uint16, None),
+        (1, 'hardware_version', FitBaseType.uint8, None),
+    ])
+    DEVICE_INFO = FitMessage('device_info', LMSG_TYPE_DEVICE_INFO, [
+        (253, 'timestamp', FitBaseType.uint32, 1),
+        (3, 'serial_number', FitBaseType.uint32z, 1),
+        (7, 'cum_operating_time', FitBaseType.uint32, 1),
+        (8, 'unknown_8', FitBaseType.uint32, None),  # undocumented
+        (2, 'manufacturer', FitBaseType.uint16, 1),
+        (4, 'product', FitBaseType.uint16, 1),
+        (5, 'software_version', FitBaseType.uint16, 100),
+        (10, 'battery_voltage', FitBaseType.uint16, 256),
+        (0, 'device_index', FitBaseType.uint8, 1),
+        (1, 'device_type', FitBaseType.uint8, 1),
+        (6, 'hardware_version', FitBaseType.uint8, 1),
+        (11, 'battery_status', FitBaseType.uint8, None),
+    ])
+
+    def __init__(self, sink=None):
+        """encode into sink, any seekable binary file-like object
+
+        Records are written to the sink as they are encoded while the CRC
+        and size are kept running, so only the header needs to be patched
+        in place by finish(). Without a sink an in-memory buffer is used."""
+        self.buf = BytesIO() if sink is None else sink
+        self.start = self.buf.tell()
+        self.data_crc = 0
+        self.data_size = 0
         self.write_header()  # create header first
-        self.device_info_defined = False
+        self.defined = set()
+        self.last_device = None
 
     def __str__(self):
         orig_pos = self.buf.tell()
@@ -97,99 +247,106 @@ class FitEncoder(Fit):
                      profile_version=108,
                      data_size=0,
                      data_type=b'.FIT'):
-        self.buf.seek(0)
-        s = pack('BBHI4s', header_size, protocol_version, profile_version, data_size, data_type)
-        self.buf.write(s)
-
-    def _build_content_block(self, content):
-        field_defs = []
-        values = []
-        for num, basetype, value, scale in content:
-            s = pack('BBB', num, basetype['size'], basetype['field'])
-            field_defs.append(s)
-            if value is None:
-                # invalid value
-                value = basetype['invalid']
-            elif scale is not None:
-                value *= scale
-            values.append(FitBaseType.pack(basetype, value))
-        return (b''.join(field_defs), b''.join(values))
+        self.buf.seek(self.start)
+        self.header = pack('<BBHI4s', header_size, protocol_version, profile_version, data_size, data_type)
+        self.buf.write(self.header)
+        self.buf.seek(self.start + len(self.header) + self.data_size)
+
+    def write(self, data):
+        """append data records, keeping CRC and size running"""
+        self.buf.write(data)
+        self.data_crc = crc16(data, self.data_crc)
+        self.data_size += len(data)
+
+    def write_message(self, message, values, redefine=False):
+        """write a data message, preceded by its definition on first use"""
+        if redefine or message.lmsg_type not in self.defined:
+            self.write(message.definition)
+            self.defined.add(message.lmsg_type)
+        self.write(message.pack(values))
+
+    def write_message_columns(self, messages, count):
+        """write count rows of records, interleaving the message types
+
+        messages is a sequence of (FitMessage, columns, rows) where rows is
+        None to write a record in every row, or a sequence of booleans
+        selecting the rows that get one. The records are packed in bulk and
+        written with a single write."""
+        packed = []
+        for message, columns, rows in messages:
+            if rows is not None:
+                columns = [None if column is None else list(compress(column, rows)) for column in columns]
+            packed.append(iter(message.pack_columns(columns, count if rows is None else sum(rows))))
+
+        chunks = []
+        for row in range(count):
+            for (message, _, rows), records in zip(messages, packed):
+                if rows is not None and not rows[row]:
+                    continue
+                # definitions go right before the first record of their type
+                if message.lmsg_type not in self.defined:
+                    chunks.append(message.definition)
+                    self.defined.add(message.lmsg_type)
+                chunks.append(next(records))
+        self.write(b''.join(chunks))
+
+    @classmethod
+    def records_per_file(cls, message, max_size, device_info=DEVICE_INFO_EVERY):
+        """number of message records that fit in a file of max_size bytes"""
+        overhead = cls.HEADER_SIZE + 2  # header and crc
+        for fixed in (cls.FILE_ID, cls.FILE_CREATOR, cls.DEVICE_INFO, message):
+            overhead += len(fixed.definition)
+        for fixed in (cls.FILE_ID, cls.FILE_CREATOR, cls.DEVICE_INFO):
+            overhead += fixed.struct.size
+        row_size = message.struct.size
+        if device_info != cls.DEVICE_INFO_ONCE:
+            # worst case, a device_info record before every measurement
+            row_size += cls.DEVICE_INFO.struct.size
+        return max(1, (max_size - overhead) // row_size)
+
+    def device_info_rows(self, count, device_info, devices=None):
+        """rows of a batch that are preceded by a device_info record
+
+        device_info is one of DEVICE_INFO_EVERY, DEVICE_INFO_ONCE (the
+        first record of the file) or DEVICE_INFO_CHANGED (whenever the
+        device in the devices column differs from the previous record)."""
+        if device_info == self.DEVICE_INFO_EVERY:
+            return None
+        if device_info == self.DEVICE_INFO_ONCE:
+            rows = [False] * count
+            if count and self.LMSG_TYPE_DEVICE_INFO not in self.defined:
+                rows[0] = True
+            return rows
+        if device_info == self.DEVICE_INFO_CHANGED:
+            if devices is None:
+                devices = [None] * count
+            rows = []
+            first = self.LMSG_TYPE_DEVICE_INFO not in self.defined
+            for device in devices:
+                rows.append(first or device != self.last_device)
+                first = False
+                self.last_device = device
+            return rows
+        raise ValueError('Unknown device_info mode %r' % (device_info,))
 
     def write_file_info(self, serial_number=None, time_created=None, manufacturer=None, product=None, number=None):
         if time_created is None:
             time_created = datetime.now()
 
-        content = [
-            (3, FitBaseType.uint32z, serial_number, None),
-            (4, FitBaseType.uint32, self.timestamp(time_created), None),
-            (1, FitBaseType.uint16, manufacturer, None),
-            (2, FitBaseType.uint16, product, None),
-            (5, FitBaseType.uint16, number, None),
-            (0, FitBaseType.enum, self.FILE_TYPE, None),  # type
-        ]
-        fields, values = self._build_content_block(content)
-
-        # create fixed content
-        msg_number = self.GMSG_NUMS['file_id']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            fixed_content,
-            fields,
-            # record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_INFO),
-            values,
-        ]))
+        self.write_message(self.FILE_ID, (
+            serial_number, self.timestamp(time_created), manufacturer, product, number, self.FILE_TYPE,
+        ), redefine=True)
 
     def write_file_creator(self, software_version=None, hardware_version=None):
-        content = [
-            (0, FitBaseType.uint16, software_version, None),
-            (1, FitBaseType.uint8, hardware_version, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        msg_number = self.GMSG_NUMS['file_creator']
-        fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-        self.buf.write(b''.join([
-            # definition
-            self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            fixed_content,
-            fields,
-            # record
-            self.record_header(lmsg_type=self.LMSG_TYPE_FILE_CREATOR),
-            values,
-        ]))
+        self.write_message(self.FILE_CREATOR, (software_version, hardware_version), redefine=True)
 
     def write_device_info(self, timestamp, serial_number=None, cum_operationg_time=None, manufacturer=None,
                           product=None, software_version=None, battery_voltage=None, device_index=None,
                           device_type=None, hardware_version=None, battery_status=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (3, FitBaseType.uint32z, serial_number, 1),
-            (7, FitBaseType.uint32, cum_operationg_time, 1),
-            (8, FitBaseType.uint32, None, None),  # unknown field(undocumented)
-            (2, FitBaseType.uint16, manufacturer, 1),
-            (4, FitBaseType.uint16, product, 1),
-            (5, FitBaseType.uint16, software_version, 100),
-            (10, FitBaseType.uint16, battery_voltage, 256),
-            (0, FitBaseType.uint8, device_index, 1),
-            (1, FitBaseType.uint8, device_type, 1),
-            (6, FitBaseType.uint8, hardware_version, 1),
-            (11, FitBaseType.uint8, battery_status, None),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.device_info_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-            msg_number = self.GMSG_NUMS['device_info']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.device_info_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_DEVICE_INFO)
-        self.buf.write(header + values)
+        self.write_message(self.DEVICE_INFO, (
+            self.timestamp(timestamp), serial_number, cum_operationg_time, None, manufacturer, product,
+            software_version, battery_voltage, device_index, device_type, hardware_version, battery_status,
+        ))
 
     def record_header(self, definition=False, lmsg_type=0):
         msg = 0
@@ -198,36 +355,34 @@ class FitEncoder(Fit):
         return pack('B', msg + lmsg_type)
 
     def crc(self):
-        orig_pos = self.buf.tell()
-        self.buf.seek(0)
-
-        crc = 0
-        while True:
-            b = self.buf.read(1)
-            if not b:
-                break
-            crc = _calcCRC(crc, unpack('b', b)[0])
-        self.buf.seek(orig_pos)
-        return pack('H', crc)
+        crc = crc16_combine(crc16(self.header), self.data_crc, self.data_size)
+        return pack('<H', crc)
 
     def finish(self):
-        """re-weite file-header, then append crc to end of file"""
-        data_size = self.get_size() - self.HEADER_SIZE
-        self.write_header(data_size=data_size)
-        crc = self.crc()
-        self.buf.seek(0, 2)
-        self.buf.write(crc)
+        """re-write file-header in place, then append crc to end of file"""
+        self.write_header(data_size=self.data_size)
+        self.buf.write(self.crc())
+        self.buf.flush()
 
     def get_size(self):
-        orig_pos = self.buf.tell()
-        self.buf.seek(0, 2)
-        size = self.buf.tell()
-        self.buf.seek(orig_pos)
-        return size
+        return self.buf.tell() - self.start
 
     def getvalue(self):
         return self.buf.getvalue()
 
+    def getbuffer(self):
+        """view of the in-memory FIT data without copying it"""
+        return self.buf.getbuffer()
+
+    @property
+    def path(self):
+        """path of the file the encoder streams to, None if in memory"""
+        name = getattr(self.buf, 'name', None)
+        return name if isinstance(name, str) else None
+
+    def close(self):
+        self.buf.close()
+
     def timestamp(self, t):
         """the timestamp in fit protocol is seconds since
         UTC 00:00 Dec 31 1989 (631065600)"""
@@ -240,9 +395,17 @@ class FitEncoderBloodPressure(FitEncoder):
     # Here might be dragons - no idea what lsmg stand for, found 14 somewhere in the deepest web
     LMSG_TYPE_BLOOD_PRESSURE = 14
 
-    def __init__(self):
-        super().__init__()
-        self.blood_pressure_monitor_defined = False
+    # BLOOD PRESSURE FILE MESSAGES
+    BLOOD_PRESSURE = FitMessage('blood_pressure', LMSG_TYPE_BLOOD_PRESSURE, [
+        (253, 'timestamp', FitBaseType.uint32, 1),
+        (0, 'systolic_pressure', FitBaseType.uint16, 1),
+        (1, 'diastolic_pressure', FitBaseType.uint16, 1),
+        (2, 'mean_arterial_pressure', FitBaseType.uint16, 1),
+        (3, 'map_3_sample_mean', FitBaseType.uint16, 1),
+        (4, 'map_morning_values', FitBaseType.uint16, 1),
+        (5, 'map_evening_values', FitBaseType.uint16, 1),
+        (6, 'heart_rate', FitBaseType.uint8, 1),
+    ])
 
     def write_blood_pressure(self,
                              timestamp,
@@ -253,64 +416,197 @@ class FitEncoderBloodPressure(FitEncoder):
                              map_morning_values=None,
                              map_evening_values=None,
                              heart_rate=None, ):
-        # BLOOD PRESSURE FILE MESSAGES
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, systolic_blood_pressure, 1),
-            (1, FitBaseType.uint16, diastolic_blood_pressure, 1),
-            (2, FitBaseType.uint16, mean_arterial_pressure, 1),
-            (3, FitBaseType.uint16, map_3_sample_mean, 1),
-            (4, FitBaseType.uint16, map_morning_values, 1),
-            (5, FitBaseType.uint16, map_evening_values, 1),
-            (6, FitBaseType.uint8, heart_rate, 1),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.blood_pressure_monitor_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_BLOOD_PRESSURE)
-            msg_number = self.GMSG_NUMS['blood_pressure']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.blood_pressure_monitor_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_BLOOD_PRESSURE)
-        self.buf.write(header + values)
+        self.write_message(self.BLOOD_PRESSURE, (
+            self.timestamp(timestamp), systolic_blood_pressure, diastolic_blood_pressure, mean_arterial_pressure,
+            map_3_sample_mean, map_morning_values, map_evening_values, heart_rate,
+        ))
+
+    def write_blood_pressures(self, timestamps, diastolic_blood_pressure=None, systolic_blood_pressure=None,
+                              heart_rate=None, device_info=None, devices=None):
+        """write a batch of blood pressure records from columns of values
+
+        With device_info, device_info records are interleaved according to
+        that mode, see device_info_rows()."""
+        timestamps = [self.timestamp(t) for t in timestamps]
+        messages = [(self.BLOOD_PRESSURE, (
+            timestamps, systolic_blood_pressure, diastolic_blood_pressure,
+            None, None, None, None, heart_rate,
+        ), None)]
+        if device_info:
+            rows = self.device_info_rows(len(timestamps), device_info, devices)
+            messages.insert(0, (self.DEVICE_INFO, (timestamps,), rows))
+        self.write_message_columns(messages, len(timestamps))
 
 
 class FitEncoderWeight(FitEncoder):
     LMSG_TYPE_WEIGHT_SCALE = 3
 
-    def __init__(self):
-        super().__init__()
-        self.weight_scale_defined = False
+    WEIGHT_SCALE = FitMessage('weight_scale', LMSG_TYPE_WEIGHT_SCALE, [
+        (253, 'timestamp', FitBaseType.uint32, 1),
+        (0, 'weight', FitBaseType.uint16, 100),
+        (1, 'percent_fat', FitBaseType.uint16, 100),
+        (2, 'percent_hydration', FitBaseType.uint16, 100),
+        (3, 'visceral_fat_mass', FitBaseType.uint16, 100),
+        (4, 'bone_mass', FitBaseType.uint16, 100),
+        (5, 'muscle_mass', FitBaseType.uint16, 100),
+        (7, 'basal_met', FitBaseType.uint16, 4),
+        (9, 'active_met', FitBaseType.uint16, 4),
+        (8, 'physique_rating', FitBaseType.uint8, 1),
+        (10, 'metabolic_age', FitBaseType.uint8, 1),
+        (11, 'visceral_fat_rating', FitBaseType.uint8, 1),
+        (13, 'bmi', FitBaseType.uint16, 10),
+    ])
 
     def write_weight_scale(self, timestamp, weight, percent_fat=None, percent_hydration=None,
                            visceral_fat_mass=None, bone_mass=None, muscle_mass=None, basal_met=None,
                            active_met=None, physique_rating=None, metabolic_age=None,
                            visceral_fat_rating=None, bmi=None):
-        content = [
-            (253, FitBaseType.uint32, self.timestamp(timestamp), 1),
-            (0, FitBaseType.uint16, weight, 100),
-            (1, FitBaseType.uint16, percent_fat, 100),
-            (2, FitBaseType.uint16, percent_hydration, 100),
-            (3, FitBaseType.uint16, visceral_fat_mass, 100),
-            (4, FitBaseType.uint16, bone_mass, 100),
-            (5, FitBaseType.uint16, muscle_mass, 100),
-            (7, FitBaseType.uint16, basal_met, 4),
-            (9, FitBaseType.uint16, active_met, 4),
-            (8, FitBaseType.uint8, physique_rating, 1),
-            (10, FitBaseType.uint8, metabolic_age, 1),
-            (11, FitBaseType.uint8, visceral_fat_rating, 1),
-            (13, FitBaseType.uint16, bmi, 10),
-        ]
-        fields, values = self._build_content_block(content)
-
-        if not self.weight_scale_defined:
-            header = self.record_header(definition=True, lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-            msg_number = self.GMSG_NUMS['weight_scale']
-            fixed_content = pack('BBHB', 0, 0, msg_number, len(content))  # reserved, architecture(0: little endian)
-            self.buf.write(header + fixed_content + fields)
-            self.weight_scale_defined = True
-
-        header = self.record_header(lmsg_type=self.LMSG_TYPE_WEIGHT_SCALE)
-        self.buf.write(header + values)
+        self.write_message(self.WEIGHT_SCALE, (
+            self.timestamp(timestamp), weight, percent_fat, percent_hydration, visceral_fat_mass, bone_mass,
+            muscle_mass, basal_met, active_met, physique_rating, metabolic_age, visceral_fat_rating, bmi,
+        ))
+
+    def write_weight_scales(self, timestamps, weight, percent_fat=None, percent_hydration=None,
+                            bone_mass=None, muscle_mass=None, bmi=None, device_info=None, devices=None):
+        """write a batch of weight scale records from columns of values
+
+        With device_info, device_info records are interleaved according to
+        that mode, see device_info_rows()."""
+        timestamps = [self.timestamp(t) for t in timestamps]
+        messages = [(self.WEIGHT_SCALE, (
+            timestamps, weight, percent_fat, percent_hydration, None, bone_mass, muscle_mass,
+            None, None, None, None, None, bmi,
+        ), None)]
+        if device_info:
+            rows = self.device_info_rows(len(timestamps), device_info, devices)
+            messages.insert(0, (self.DEVICE_INFO, (timestamps,), rows))
+        self.write_message_columns(messages, len(timestamps))
+
+
+class FitDecodeError(Exception):
+    """Raised for malformed or corrupt FIT data"""
+
+
+class FitDecoder(Fit):
+    """Streaming decoder for the FIT files written by the encoders
+
+    Iterating yields (message name, fields) for each data message. Values
+    are scaled back, timestamps are converted to datetime and invalid values
+    decode to None. Header and file CRC are checked while reading."""
+
+    BASE_TYPES = {basetype['field']: basetype for basetype in (
+        FitBaseType.enum, FitBaseType.sint8, FitBaseType.uint8, FitBaseType.sint16, FitBaseType.uint16,
+        FitBaseType.sint32, FitBaseType.uint32, FitBaseType.string, FitBaseType.float32, FitBaseType.float64,
+        FitBaseType.uint8z, FitBaseType.uint16z, FitBaseType.uint32z, FitBaseType.byte,
+    )}
+    MESSAGES = {Fit.GMSG_NUMS[message.name]: message for message in (
+        FitEncoder.FILE_ID, FitEncoder.FILE_CREATOR, FitEncoder.DEVICE_INFO,
+        FitEncoderWeight.WEIGHT_SCALE, FitEncoderBloodPressure.BLOOD_PRESSURE,
+    )}
+    TIMESTAMP_FIELDS = ('timestamp', 'time_created')
+
+    def __init__(self, source):
+        """source is a bytes-like object or a binary file-like object"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        self.source = source
+        self.crc = 0
+        self.header = None
+
+    def _read(self, size):
+        data = self.source.read(size)
+        if len(data) != size:
+            raise FitDecodeError('Unexpected end of FIT data')
+        self.crc = crc16(data, self.crc)
+        return data
+
+    def read_header(self):
+        header_size = self._read(1)[0]
+        if header_size not in (Fit.HEADER_SIZE, Fit.HEADER_SIZE + 2):
+            raise FitDecodeError('Invalid FIT header size %d' % header_size)
+        header = self._read(header_size - 1)
+        protocol_version, profile_version, data_size, data_type = unpack('<BHI4s', header[:11])
+        if data_type != b'.FIT':
+            raise FitDecodeError('Missing .FIT signature')
+        if header_size > Fit.HEADER_SIZE:
+            header_crc = unpack('<H', header[11:13])[0]
+            if header_crc and header_crc != crc16(bytes([header_size]) + header[:11]):
+                raise FitDecodeError('FIT header CRC mismatch')
+        self.header = {
+            'header_size': header_size,
+            'protocol_version': protocol_version,
+            'profile_version': profile_version,
+            'data_size': data_size,
+        }
+        return self.header
+
+    def _compile(self, endian, gmsg_num, raw_fields):
+        """build the name, struct and field list of a definition message"""
+        message = self.MESSAGES.get(gmsg_num)
+        profile = {}
+        if message is not None:
+            profile = {num: (name, scale) for num, name, _, scale in message.fields}
+        fmt = endian
+        fields = []
+        for i in range(0, len(raw_fields), 3):
+            num, size, base = raw_fields[i:i + 3]
+            basetype = self.BASE_TYPES.get(base)
+            field_fmt = FitBaseType.get_format(basetype) if basetype else None
+            if field_fmt is not None and Struct(field_fmt).size == size:
+                fmt += field_fmt
+                invalid = basetype['invalid']
+            else:
+                # arrays and unknown base types are returned as raw bytes
+                fmt += '%ds' % size
+                invalid = None
+            name, scale = profile.get(num, ('field_%d' % num, None))
+            fields.append((name, scale, invalid))
+        name = message.name if message is not None else 'message_%d' % gmsg_num
+        return name, Struct(fmt), fields
+
+    def _decode(self, fields, values):
+        record = {}
+        for (name, scale, invalid), value in zip(fields, values):
+            if value == invalid:
+                value = None
+            elif name in self.TIMESTAMP_FIELDS:
+                value = datetime.fromtimestamp(value + 631065600)
+            elif scale is not None and scale != 1:
+                value /= scale
+            record[name] = value
+        return record
+
+    def __iter__(self):
+        header = self.read_header()
+        definitions = {}
+        remaining = header['data_size']
+        while remaining > 0:
+            record_header = self._read(1)[0]
+            remaining -= 1
+            if record_header & 0x80:
+                raise FitDecodeError('Compressed timestamp headers are not supported')
+            if record_header & 0x20:
+                raise FitDecodeError('Developer data is not supported')
+            lmsg_type = record_header & 0x0F
+
+            if record_header & 0x40:
+                fixed_content = self._read(5)
+                endian = '>' if fixed_content[1] else '<'
+                gmsg_num, num_fields = unpack(endian + 'HB', fixed_content[2:])
+                raw_fields = self._read(3 * num_fields)
+                remaining -= 5 + 3 * num_fields
+                definitions[lmsg_type] = self._compile(endian, gmsg_num, raw_fields)
+                continue
+
+            if lmsg_type not in definitions:
+                raise FitDecodeError('Data message without definition (local type %d)' % lmsg_type)
+            name, struct, fields = definitions[lmsg_type]
+            data = self._read(struct.size)
+            remaining -= struct.size
+            yield name, self._decode(fields, struct.unpack(data))
+
+        if remaining < 0:
+            raise FitDecodeError('Record exceeds FIT data size')
+        crc = self.source.read(2)
+        if len(crc) != 2 or unpack('<H', crc)[0] != self.crc:
+            raise FitDecodeError('FIT file CRC mismatch')
@@ -4,10 +4,13 @@ import logging
 import os
 import sys
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
 
 from garminconnect import Garmin
 
+from withings_sync.pipeline import RateLimiter
+
 log = logging.getLogger("garmin")
 
 HOME = os.getenv("HOME", ".")
@@ -18,6 +21,11 @@ GARMIN_SESSION = os.path.abspath(
 )
 
 TOKENSTORE_FILENAME = "garmin_tokens.json"
+UPLOAD_FILENAME = "withings-sync.fit"
+
+# concurrent uploads and the minimum delay between starting two of them
+UPLOAD_WORKERS = int(os.getenv("GARMIN_UPLOAD_WORKERS", "4"))
+UPLOAD_INTERVAL = float(os.getenv("GARMIN_UPLOAD_INTERVAL", "0.5"))
 
 
 class LoginFailed(Exception):
@@ -28,6 +36,14 @@ class APIException(Exception):
     """Raised for API exceptions."""
 
 
+def memory_tempdir():
+    """Return a tmpfs backed directory for temporary files, None if there is none."""
+    for path in ("/dev/shm", os.getenv("XDG_RUNTIME_DIR")):
+        if path and os.path.isdir(path) and os.access(path, os.W_OK):
+            return path
+    return None
+
+
 class GarminConnect:
     """Main GarminConnect class."""
 
@@ -166,12 +182,75 @@ class GarminConnect:
 
     def upload_file(self, ffile):
         """Upload fit file to Garmin Connect."""
-        # python-garminconnect only accepts file paths, not file-like objects
-        with tempfile.NamedTemporaryFile(suffix=".fit", delete=False) as tmp:
-            tmp.write(ffile.getvalue())
-            tmp_path = tmp.name
+        # an encoder streaming to a file can be uploaded from its path
+        path = getattr(ffile, "path", None)
+        if path:
+            self.client.upload_activity(path)
+            return True
+
+        getbuffer = getattr(ffile, "getbuffer", None)
+        data = getbuffer() if getbuffer else ffile.getvalue()
+        try:
+            http = getattr(self.client, "client", None)
+            if hasattr(http, "post"):
+                # post the in-memory buffer as multipart body, like
+                # upload_activity does with the opened file
+                http.post(
+                    "connectapi",
+                    self.client.garmin_connect_upload,
+                    files={"file": (UPLOAD_FILENAME, data)},
+                    api=True,
+                )
+                return True
+
+            # upload_activity only accepts file paths, keep the file in memory
+            # where possible
+            with tempfile.NamedTemporaryFile(
+                suffix=".fit", delete=False, dir=memory_tempdir()
+            ) as tmp:
+                tmp.write(data)
+                tmp_path = tmp.name
+        finally:
+            if isinstance(data, memoryview):
+                data.release()
         try:
             self.client.upload_activity(tmp_path)
         finally:
             os.unlink(tmp_path)
         return True
+
+    def upload_files(self, ffiles, workers=UPLOAD_WORKERS, interval=UPLOAD_INTERVAL):
+        """Upload fit files to Garmin Connect concurrently.
+
+        ffiles may be any iterable; files are uploaded as they come in. All
+        uploads share the authenticated client. Yields an (ffile, error)
+        pair per file as soon as its upload finished, error is None when
+        the upload succeeded.
+        """
+        limiter = RateLimiter(interval)
+
+        def upload(ffile):
+            limiter.wait()
+            try:
+                self.upload_file(ffile)
+            except Exception as ex:  # pylint: disable=broad-except
+                log.error("Upload to Garmin Connect failed: %s", ex)
+                return ffile, ex
+            return ffile, None
+
+        if workers <= 1:
+            for ffile in ffiles:
+                yield upload(ffile)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = set()
+            for ffile in ffiles:
+                if len(running) >= workers:
+                    # wait for a free worker before taking the next file
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                running.add(pool.submit(upload, ffile))
+            for future in as_completed(running):
+                yield future.result()
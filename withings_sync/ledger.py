@@ -0,0 +1,101 @@
+"""This module keeps track of the measurements uploaded to Garmin Connect."""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+log = logging.getLogger("ledger")
+
+HOME = os.environ.get("HOME", ".")
+LEDGER = os.environ.get("WITHINGS_SYNC_LEDGER", HOME + "/.withings_sync_ledger.sqlite")
+LEDGER_FILENAME = "upload_ledger.sqlite"
+
+# SQLite limits the number of parameters of a single statement
+QUERY_CHUNK = 500
+
+
+def record_hash(record, fields):
+    """Return a stable hash of what a syncdata record puts on Garmin Connect.
+
+    Only the date, the type and the fields written to the FIT file count,
+    so that raw data or values Garmin never sees do not cause a reupload."""
+    values = {key: record.get(key) for key in fields}
+    values["date_time"] = record["date_time"]
+    values["type"] = record["type"]
+    payload = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+
+class UploadLedger:
+    """Hashes of all measurements uploaded to Garmin Connect"""
+
+    def __init__(self, fields, config_folder=None):
+        # syncdata keys written to the FIT file, by record type
+        self.fields = fields
+        if config_folder:
+            self.path = os.path.join(config_folder, LEDGER_FILENAME)
+        else:
+            self.path = LEDGER
+        # records filter_new found in the ledger
+        self.skipped = 0
+        # filled and queried from different stages of a sync
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS uploaded ("
+                " hash BLOB PRIMARY KEY,"
+                " date INTEGER NOT NULL,"
+                " type TEXT NOT NULL"
+                ") WITHOUT ROWID"
+            )
+
+    def hash(self, record):
+        """Return the hash a record is known by"""
+        return record_hash(record, self.fields[record["type"]])
+
+    def filter_new(self, records):
+        """Return the records that were not uploaded before"""
+        hashes = [self.hash(record) for record in records]
+        known = set()
+        with self.lock:
+            for i in range(0, len(hashes), QUERY_CHUNK):
+                chunk = hashes[i : i + QUERY_CHUNK]
+                placeholders = ",".join("?" * len(chunk))
+                known.update(
+                    row[0]
+                    for row in self.db.execute(
+                        f"SELECT hash FROM uploaded WHERE hash IN ({placeholders})",
+                        chunk,
+                    )
+                )
+        log.debug("%d of %d records were uploaded before", len(known), len(records))
+        self.skipped += len(known)
+        return [r for r, h in zip(records, hashes) if h not in known]
+
+    def iter_new(self, records):
+        """Yield the records that were not uploaded before, checking in batches"""
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= QUERY_CHUNK:
+                yield from self.filter_new(batch)
+                batch = []
+        if batch:
+            yield from self.filter_new(batch)
+
+    def add(self, records):
+        """Record uploaded records"""
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO uploaded VALUES (?, ?, ?)",
+                (
+                    (self.hash(r), int(r["date_time"].timestamp()), r["type"])
+                    for r in records
+                ),
+            )
+
+    def close(self):
+        self.db.close()
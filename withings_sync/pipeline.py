@@ -0,0 +1,115 @@
+"""This module runs the stages of a sync concurrently."""
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger("pipeline")
+
+# items buffered between two stages before the producing stage has to wait
+QUEUE_SIZE = 256
+
+_DONE = object()
+
+
+class Stage:
+    """Iterate an iterable in a background thread
+
+    The items are handed over through a bounded queue, so the stage runs
+    ahead of its consumer by at most maxsize items. Iterating the stage
+    yields the items in order and re-raises an exception of the iterable.
+    close() stops the thread, also when the consumer gave up early."""
+
+    def __init__(self, iterable, name, maxsize=QUEUE_SIZE):
+        self.name = name
+        self.queue = queue.Queue(maxsize)
+        self.stopping = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(
+            target=self._run, args=(iterable,), name=name, daemon=True
+        )
+        self.thread.start()
+
+    def _put(self, item):
+        """queue an item, False if the stage was closed while waiting"""
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put(item):
+                    break
+        except BaseException as ex:  # pylint: disable=broad-except
+            # handed to the consumer
+            self.error = ex
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+            self._finish()
+        log.debug("Stage %s done", self.name)
+
+    def _finish(self):
+        """queue _DONE, also after close() so that a waiting consumer wakes up"""
+        if self._put(_DONE):
+            return
+        # closed: drop the items nobody takes anymore, this thread is the
+        # only producer so there is room for _DONE afterwards
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.queue.put_nowait(_DONE)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _DONE:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """stop the stage"""
+        self.stopping.set()
+
+
+def collect(iterable, items):
+    """Pass the items of iterable on, appending each of them to items"""
+    for item in iterable:
+        items.append(item)
+        yield item
+
+
+class RateLimiter:
+    """Space out calls by a minimum interval, shared between threads."""
+
+    def __init__(self, interval) -> None:
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def reserve(self):
+        """Reserve the next call, return the seconds to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        return max(delay, 0.0)
+
+    def wait(self):
+        """Block until the next call is allowed."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,160 @@
+"""This module keeps a local copy of the Withings measurements."""
+import logging
+import os
+import sqlite3
+
+from withings_sync.withings2 import WithingsMeasure, WithingsMeasureGroup
+
+log = logging.getLogger("store")
+
+HOME = os.environ.get("HOME", ".")
+STORE = os.environ.get(
+    "WITHINGS_SYNC_STORE", HOME + "/.withings_sync_measurements.sqlite"
+)
+STORE_FILENAME = "measurements.sqlite"
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS measuregrps ("
+    " grpid INTEGER PRIMARY KEY,"
+    " date INTEGER NOT NULL,"
+    " modified INTEGER NOT NULL,"
+    " category INTEGER,"
+    " attrib INTEGER,"
+    " deviceid TEXT"
+    ")",
+    "CREATE TABLE IF NOT EXISTS measures ("
+    " grpid INTEGER NOT NULL REFERENCES measuregrps (grpid),"
+    " type INTEGER NOT NULL,"
+    " date INTEGER NOT NULL,"
+    " value INTEGER NOT NULL,"
+    " unit INTEGER NOT NULL"
+    ")",
+    "CREATE INDEX IF NOT EXISTS measures_type_date ON measures (type, date)",
+    "CREATE INDEX IF NOT EXISTS measures_grpid ON measures (grpid)",
+    "CREATE INDEX IF NOT EXISTS measuregrps_date ON measuregrps (date)",
+    "CREATE INDEX IF NOT EXISTS measuregrps_modified ON measuregrps (modified)",
+    "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER)",
+    "CREATE TABLE IF NOT EXISTS backfill ("
+    " startdate INTEGER NOT NULL,"
+    " enddate INTEGER NOT NULL,"
+    " PRIMARY KEY (startdate, enddate)"
+    ")",
+)
+
+
+class MeasurementStore:
+    """SQLite copy of the Withings measurement groups"""
+
+    def __init__(self, config_folder=None):
+        if config_folder:
+            self.path = os.path.join(config_folder, STORE_FILENAME)
+        else:
+            self.path = STORE
+        # used by the fetch stage and by syncs started from other threads
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def get_state(self, key):
+        """get a bookkeeping value, None if not set"""
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, key, value):
+        """set a bookkeeping value"""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+    def get_backfilled(self):
+        """get the (startdate, enddate) windows of an unfinished backfill"""
+        return set(self.db.execute("SELECT startdate, enddate FROM backfill"))
+
+    def add_backfilled(self, startdate, enddate):
+        """checkpoint a completely stored backfill window"""
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO backfill VALUES (?, ?)", (startdate, enddate)
+            )
+
+    def clear_backfilled(self):
+        """forget the backfill windows once the backfill has finished"""
+        with self.db:
+            self.db.execute("DELETE FROM backfill")
+
+    def add_groups(self, measuregrps):
+        """store raw Withings measurement groups, replacing older versions"""
+        with self.db:
+            for group in measuregrps:
+                grpid = group["grpid"]
+                date = group["date"]
+                self.db.execute("DELETE FROM measures WHERE grpid = ?", (grpid,))
+                self.db.execute(
+                    "INSERT OR REPLACE INTO measuregrps VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        grpid,
+                        date,
+                        group.get("modified", date),
+                        group.get("category"),
+                        group.get("attrib"),
+                        group.get("hash_deviceid") or group.get("deviceid"),
+                    ),
+                )
+                self.db.executemany(
+                    "INSERT INTO measures VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (grpid, m["type"], date, m["value"], m["unit"])
+                        for m in group["measures"]
+                    ),
+                )
+        log.debug("Stored %d measurement groups", len(measuregrps))
+
+    def iter_groups(self, startdate=None, enddate=None, lastupdate=None):
+        """yield stored groups as WithingsMeasureGroup, oldest first
+
+        With lastupdate, the groups modified since then are returned instead
+        of the groups dated between startdate and enddate."""
+        if lastupdate is not None:
+            where, params = "g.modified >= ?", (lastupdate,)
+        else:
+            where, params = "g.date BETWEEN ? AND ?", (startdate, enddate)
+        rows = self.db.execute(
+            "SELECT g.grpid, g.date, g.modified, g.category, g.attrib, g.deviceid,"
+            " m.type, m.value, m.unit"
+            " FROM measuregrps g JOIN measures m ON m.grpid = g.grpid"
+            f" WHERE {where} ORDER BY g.date, g.grpid, m.rowid",
+            params,
+        )
+        group = None
+        for grpid, date, modified, category, attrib, deviceid, *measure in rows:
+            if group is None or group["grpid"] != grpid:
+                if group is not None:
+                    yield WithingsMeasureGroup(group)
+                group = {
+                    "grpid": grpid,
+                    "date": date,
+                    "modified": modified,
+                    "category": category,
+                    "attrib": attrib,
+                    "deviceid": deviceid,
+                    "measures": [],
+                }
+            meastype, value, unit = measure
+            group["measures"].append({"type": meastype, "value": value, "unit": unit})
+        if group is not None:
+            yield WithingsMeasureGroup(group)
+
+    def get_latest(self, meastype):
+        """get the latest stored value of a measure type, None if there is none"""
+        row = self.db.execute(
+            "SELECT value, unit FROM measures WHERE type = ? ORDER BY date DESC LIMIT 1",
+            (meastype,),
+        ).fetchone()
+        if row is None:
+            return None
+        value, unit = row
+        measure = WithingsMeasure({"type": meastype, "value": value, "unit": unit})
+        return round(measure.get_value(), 2)
+
+    def close(self):
+        self.db.close()
@@ -2,18 +2,38 @@
 
 import argparse
 import time
+import random
+import signal
+import threading
 import sys
 import os
 import logging
 import json
+import itertools
+import collections
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import date, datetime
 from importlib.metadata import version
 import dotenv
 
-from withings_sync.withings2 import WithingsAccount
-from withings_sync.garmin import GarminConnect
+from withings_sync.withings2 import (
+    BACKFILL_WORKERS,
+    WithingsAccount,
+    WithingsException,
+)
+from withings_sync.garmin import GarminConnect, UPLOAD_WORKERS
 from withings_sync.trainerroad import TrainerRoad
-from withings_sync.fit import FitEncoderWeight, FitEncoderBloodPressure
+from withings_sync.ledger import UploadLedger
+from withings_sync.store import MeasurementStore
+from withings_sync.webhook import NotificationReceiver, callback_url
+from withings_sync.pipeline import Stage, collect
+from withings_sync.fit import (
+    FitEncoder,
+    FitEncoderWeight,
+    FitEncoderBloodPressure,
+    FitDecoder,
+    FitDecodeError,
+)
 
 # Load the environment variables from a .env (dotenv) file.
 # This is done prior to importing other modules such that all variables,
@@ -44,6 +64,29 @@ TRAINERROAD_USERNAME = load_variable(
 TRAINERROAD_PASSWORD = load_variable(
     "TRAINERROAD_PASSWORD", "/run/secrets/trainerroad_password"
 )
+NOTIFY_TOKEN = load_variable("WITHINGS_NOTIFY_TOKEN", "/run/secrets/withings_notify_token")
+
+# --daemon: seconds between two syncs and first retry delay after a failure
+DAEMON_INTERVAL = int(os.getenv("WITHINGS_SYNC_INTERVAL", 3 * 3600))
+DAEMON_BACKOFF = 60
+
+# sync() results besides 0: nothing to sync, or a failure worth retrying
+SYNC_NOTHING = -1
+SYNC_FAILED = -2
+# --accounts: accounts synced at the same time, each in its own process
+ACCOUNT_WORKERS = int(os.getenv("WITHINGS_SYNC_ACCOUNT_WORKERS", 4))
+# settings an account profile may set; credentials are never shared
+ACCOUNT_SETTINGS = ("config_folder", "features", "output")
+ACCOUNT_CREDENTIALS = (
+    "garmin_username",
+    "garmin_password",
+    "trainerroad_username",
+    "trainerroad_password",
+)
+
+# Withings notification categories (appli) of weight and blood pressure data
+NOTIFY_APPLI_WEIGHT = 1
+NOTIFY_APPLI_BLOOD_PRESSURE = 4
 
 
 def get_args():
@@ -109,9 +152,51 @@ def get_args():
         "--todate",
         "-t",
         type=date_parser,
-        default=date.today(),
         metavar="DATE",
-        help="Date for the last sync. Ex: 2023-12-30",
+        help="Date for the last sync, today if not given. Ex: 2023-12-30",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and sync every --interval seconds, reusing the Withings, Garmin and TrainerRoad sessions.",
+    )
+
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=DAEMON_INTERVAL,
+        metavar="SECONDS",
+        help=f"Seconds between two syncs in --daemon mode. (default: {DAEMON_INTERVAL})",
+    )
+
+    parser.add_argument(
+        "--listen",
+        metavar="[HOST:]PORT",
+        help="Receive Withings notifications on this address and sync the notified period right away.",
+    )
+
+    parser.add_argument(
+        "--notify-url",
+        metavar="URL",
+        help="Public URL of --listen to subscribe to Withings notifications.",
+    )
+
+    parser.add_argument(
+        "--notify-token",
+        default=NOTIFY_TOKEN,
+        metavar="TOKEN",
+        help="Secret that notifications to --listen must carry as token query parameter.",
+    )
+
+    parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help=(
+            "Only fetch measurements created or modified since the last "
+            "successful upload. Ignored when --fromdate is given."
+        ),
     )
 
     parser.add_argument(
@@ -128,6 +213,52 @@ def get_args():
         help="Write output file in JSON format.",
     )
 
+    parser.add_argument(
+        "--fit-device-info",
+        choices=FitEncoder.DEVICE_INFO_MODES,
+        default=FitEncoder.DEVICE_INFO_EVERY,
+        help=(
+            "When to write a device_info record to FIT files: before every "
+            "measurement (default), once per file or when the Withings device changed."
+        ),
+    )
+
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=UPLOAD_WORKERS,
+        metavar="COUNT",
+        help=f"Number of FIT files uploaded to Garmin Connect concurrently. (default: {UPLOAD_WORKERS})",
+    )
+
+    parser.add_argument(
+        "--backfill-workers",
+        type=int,
+        default=BACKFILL_WORKERS,
+        metavar="COUNT",
+        help=f"Number of date windows of a long period fetched from Withings concurrently. (default: {BACKFILL_WORKERS})",
+    )
+
+    parser.add_argument(
+        "--fit-max-records",
+        type=int,
+        metavar="COUNT",
+        help="Split FIT files so that each holds at most COUNT measurements.",
+    )
+
+    parser.add_argument(
+        "--fit-max-size",
+        type=int,
+        metavar="BYTES",
+        help="Split FIT files so that none is larger than BYTES.",
+    )
+
+    parser.add_argument(
+        "--verify-fit",
+        action="store_true",
+        help="Decode the generated FIT data and compare it to the measurements before uploading.",
+    )
+
     parser.add_argument(
         "--output",
         "-o",
@@ -142,6 +273,24 @@ def get_args():
         help="Won't upload to Garmin Connect or TrainerRoad.",
     )
 
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        help="Keep all measurements in a local database and only fetch new ones from Withings.",
+    )
+
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Read measurements from the local database only, without contacting Withings. Implies --store.",
+    )
+
+    parser.add_argument(
+        "--reupload",
+        action="store_true",
+        help="Upload measurements to Garmin Connect even if they were uploaded before.",
+    )
+
     parser.add_argument(
         "--features",
         nargs="+",
@@ -165,6 +314,20 @@ def get_args():
         ),
     )
 
+    parser.add_argument(
+        "--accounts",
+        metavar="FILE",
+        help="Sync every account profile in this JSON file instead of a single account.",
+    )
+
+    parser.add_argument(
+        "--account-workers",
+        type=int,
+        default=ACCOUNT_WORKERS,
+        metavar="COUNT",
+        help=f"Number of accounts synced concurrently with --accounts. (default: {ACCOUNT_WORKERS})",
+    )
+
     parser.add_argument(
         "--config-folder",
         "-c",
@@ -173,83 +336,300 @@ def get_args():
         help="Path to config folder for session files (if not specified, uses legacy paths in home directory)",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    # each account syncs once in its own process, there is no loop to keep
+    if args.accounts and (args.daemon or args.listen):
+        parser.error("--accounts cannot be combined with --daemon or --listen")
+    return args
+
+
+def sync_garmin_shards(shards, garmin, withings, ledger=None):
+    """Sync FIT shards to Garmin Connect, skipping shards uploaded before
 
+    Shards are uploaded concurrently as they come in. Returns a dict
+    telling per kind of data whether all of its shards made it to Garmin
+    Connect."""
+    uploaded = withings.get_uploaded_shards()
+    states = {}
+    pending = {}
 
-def sync_garmin(fit_file, garmin=None, config_folder=None):
-    """Sync generated fit file to Garmin Connect"""
-    if garmin is None:
-        garmin = GarminConnect(config_folder=config_folder)
-        garmin.login(ARGS.garmin_username, ARGS.garmin_password)
-    return garmin.upload_file(fit_file)
+    def fit_files():
+        for shard in shards:
+            states.setdefault(shard.kind, True)
+            if shard.key in uploaded:
+                logging.info("Fit file %s was uploaded before - skipping", shard.key)
+                continue
+            pending[id(shard.fit)] = shard
+            yield shard.fit
+
+    for fit_file, error in garmin.upload_files(
+        fit_files(), workers=ARGS.upload_workers
+    ):
+        shard = pending.pop(id(fit_file))
+        if error is not None:
+            logging.error("Fit file %s could not be uploaded", shard.key)
+            states[shard.kind] = False
+            continue
+        logging.info(
+            "Fit file with %s information uploaded to Garmin Connect",
+            shard.kind.replace("_", " "),
+        )
+        withings.add_uploaded_shard(shard.key)
+        if ledger is not None:
+            ledger.add(shard.records)
+    return states
 
 
-def sync_trainerroad(last_weight):
+def sync_trainerroad(last_weight, t_road):
     """Sync measured weight to TrainerRoad"""
-    t_road = TrainerRoad(ARGS.trainerroad_username, ARGS.trainerroad_password)
-    t_road.connect()
     logging.info("Current TrainerRoad weight: %s kg ", t_road.weight)
     logging.info("Updating TrainerRoad weight to %s kg", last_weight)
     wt = round(last_weight, 1)
     t_road.weight = wt
-    t_road.disconnect()
 
     return wt
 
 
-def generate_fitdata(syncdata):
-    """Generate fit data from measured data"""
-    logging.debug("Generating fit data...")
-
-    weight_measurements = list(filter(lambda x: (x["type"] == "weight"), syncdata))
-    blood_pressure_measurements = list(
-        filter(lambda x: (x["type"] == "blood_pressure"), syncdata)
-    )
-
-    fit_weight = None
-    fit_blood_pressure = None
-
-    if len(weight_measurements) > 0:
-        fit_weight = FitEncoderWeight()
-        fit_weight.write_file_info()
-        fit_weight.write_file_creator()
-
-        for record in weight_measurements:
-            fit_weight.write_device_info(timestamp=record.get("date_time"))
-            fit_weight.write_weight_scale(
-                timestamp=record.get("date_time"),
-                weight=record.get("weight"),
-                percent_fat=record.get("fat_ratio"),
-                percent_hydration=record.get("percent_hydration"),
-                bone_mass=record.get("bone_mass"),
-                muscle_mass=record.get("muscle_mass"),
-                bmi=record.get("bmi"),
-            )
+class SyncSessions:
+    """Withings, Garmin and TrainerRoad clients shared by the runs of sync()"""
 
-        fit_weight.finish()
-    else:
-        logging.info("No weight data to sync for FIT file")
-
-    if len(blood_pressure_measurements) > 0:
-        fit_blood_pressure = FitEncoderBloodPressure()
-        fit_blood_pressure.write_file_info()
-        fit_blood_pressure.write_file_creator()
-
-        for record in blood_pressure_measurements:
-            fit_blood_pressure.write_device_info(timestamp=record.get("date_time"))
-            fit_blood_pressure.write_blood_pressure(
-                timestamp=record.get("date_time"),
-                diastolic_blood_pressure=record.get("diastolic_blood_pressure"),
-                systolic_blood_pressure=record.get("systolic_blood_pressure"),
-                heart_rate=record.get("heart_pulse"),
+    def __init__(self, config_folder):
+        self.config_folder = config_folder
+        self.store = None
+        if ARGS.store or ARGS.offline:
+            self.store = MeasurementStore(config_folder)
+        self.withings = WithingsAccount(
+            config_folder=config_folder,
+            keep_raw=ARGS.dump_raw,
+            store=self.store,
+            offline=ARGS.offline,
+        )
+        self.garmin = None
+        self.trainerroad = None
+        # held while a sync uses the sessions
+        self.lock = threading.Lock()
+
+    def get_garmin(self):
+        """Garmin client, logged in on first use"""
+        if self.garmin is None:
+            garmin = GarminConnect(config_folder=self.config_folder)
+            garmin.login(ARGS.garmin_username, ARGS.garmin_password)
+            self.garmin = garmin
+        return self.garmin
+
+    def get_trainerroad(self):
+        """TrainerRoad client, connected on first use"""
+        if self.trainerroad is None:
+            t_road = TrainerRoad(ARGS.trainerroad_username, ARGS.trainerroad_password)
+            t_road.connect()
+            self.trainerroad = t_road
+        return self.trainerroad
+
+    def reset(self):
+        """drop the upload clients, so that the next run logs in again"""
+        self.garmin = None
+        self.trainerroad = None
+
+    def close(self):
+        if self.trainerroad is not None:
+            self.trainerroad.disconnect()
+            self.trainerroad = None
+        if self.store is not None:
+            self.store.close()
+
+
+def get_column(records, key):
+    """Get the values of one key of all records"""
+    return [record.get(key) for record in records]
+
+
+class FitVerificationError(Exception):
+    """Raised when generated FIT data does not match the measurements"""
+
+
+FitShard = collections.namedtuple("FitShard", ["kind", "key", "records", "fit"])
+
+# syncdata keys and the FIT fields they are written to
+WEIGHT_FIT_FIELDS = {
+    "weight": "weight",
+    "fat_ratio": "percent_fat",
+    "percent_hydration": "percent_hydration",
+    "bone_mass": "bone_mass",
+    "muscle_mass": "muscle_mass",
+    "bmi": "bmi",
+}
+BLOOD_PRESSURE_FIT_FIELDS = {
+    "diastolic_blood_pressure": "diastolic_pressure",
+    "systolic_blood_pressure": "systolic_pressure",
+    "heart_pulse": "heart_rate",
+}
+
+# syncdata keys the upload ledger hashes, by record type
+LEDGER_FIELDS = {
+    "weight": tuple(WEIGHT_FIT_FIELDS),
+    "blood_pressure": tuple(BLOOD_PRESSURE_FIT_FIELDS),
+}
+
+
+def write_weight_records(fit_weight, records, device_info):
+    """Encode weight records column-wise in one batch"""
+    fit_weight.write_weight_scales(
+        timestamps=get_column(records, "date_time"),
+        weight=get_column(records, "weight"),
+        percent_fat=get_column(records, "fat_ratio"),
+        percent_hydration=get_column(records, "percent_hydration"),
+        bone_mass=get_column(records, "bone_mass"),
+        muscle_mass=get_column(records, "muscle_mass"),
+        bmi=get_column(records, "bmi"),
+        device_info=device_info,
+        devices=get_column(records, "device_id"),
+    )
+
+
+def write_blood_pressure_records(fit_blood_pressure, records, device_info):
+    """Encode blood pressure records column-wise in one batch"""
+    fit_blood_pressure.write_blood_pressures(
+        timestamps=get_column(records, "date_time"),
+        diastolic_blood_pressure=get_column(records, "diastolic_blood_pressure"),
+        systolic_blood_pressure=get_column(records, "systolic_blood_pressure"),
+        heart_rate=get_column(records, "heart_pulse"),
+        device_info=device_info,
+        devices=get_column(records, "device_id"),
+    )
+
+
+# FIT encoding of each kind of syncdata record
+FIT_KINDS = {
+    "weight": (
+        FitEncoderWeight,
+        FitEncoderWeight.WEIGHT_SCALE,
+        WEIGHT_FIT_FIELDS,
+        write_weight_records,
+    ),
+    "blood_pressure": (
+        FitEncoderBloodPressure,
+        FitEncoderBloodPressure.BLOOD_PRESSURE,
+        BLOOD_PRESSURE_FIT_FIELDS,
+        write_blood_pressure_records,
+    ),
+}
+
+
+def fitshard_limit(kind, device_info, max_records, max_size):
+    """Number of records per FIT shard of a kind, None if not limited"""
+    encoder, message, _, _ = FIT_KINDS[kind]
+    limit = max_records
+    if max_size:
+        by_size = encoder.records_per_file(message, max_size, device_info)
+        limit = min(limit, by_size) if limit else by_size
+    return limit or None
+
+
+def encode_fitshard(kind, records, name, open_sink, device_info):
+    """Encode records of one kind into a complete FIT file
+
+    The shard key only depends on the records, so a rerun over the same
+    data yields the same keys."""
+    encoder, _, _, write_records = FIT_KINDS[kind]
+    fit = encoder(open_sink(name) if open_sink else None)
+    fit.write_file_info()
+    fit.write_file_creator()
+    write_records(fit, records, device_info)
+    fit.finish()
+    key = "{}:{}:{}:{}".format(
+        kind,
+        int(records[0]["date_time"].timestamp()),
+        int(records[-1]["date_time"].timestamp()),
+        len(records),
+    )
+    return FitShard(kind, key, records, fit)
+
+
+def iter_fitshards(
+    records, open_sink=None, device_info="every", max_records=None, max_size=None
+):
+    """Encode records into FIT shards, each as soon as it is complete
+
+    Records of a kind are split over several FIT files of at most
+    max_records records or max_size bytes; shards are then named
+    "weight.001", "weight.002", ... instead of "weight"."""
+    limits = {
+        kind: fitshard_limit(kind, device_info, max_records, max_size)
+        for kind in FIT_KINDS
+    }
+    chunks = {kind: [] for kind in FIT_KINDS}
+    counts = dict.fromkeys(FIT_KINDS, 0)
+
+    def encode(kind):
+        counts[kind] += 1
+        name = f"{kind}.{counts[kind]:03d}" if limits[kind] else kind
+        chunk, chunks[kind] = chunks[kind], []
+        return encode_fitshard(kind, chunk, name, open_sink, device_info)
+
+    for record in records:
+        chunk = chunks.get(record["type"])
+        if chunk is None:
+            continue
+        chunk.append(record)
+        if limits[record["type"]] and len(chunk) >= limits[record["type"]]:
+            yield encode(record["type"])
+
+    for kind, chunk in chunks.items():
+        if chunk:
+            yield encode(kind)
+        elif not counts[kind]:
+            logging.info("No %s data to sync for FIT file", kind.replace("_", " "))
+
+
+def verify_fitshard(shard):
+    """Decode a FIT shard and compare it against its source records"""
+    _, message, fit_fields, _ = FIT_KINDS[shard.kind]
+    scales = {name: scale for _, name, _, scale in message.fields}
+    fit_data = shard.fit
+    source = open(fit_data.path, "rb") if fit_data.path else fit_data.getvalue()
+    errors = []
+    try:
+        decoded = [
+            fields for name, fields in FitDecoder(source) if name == message.name
+        ]
+    except FitDecodeError as ex:
+        return [f"{shard.key}: {ex}"]
+    finally:
+        if fit_data.path:
+            source.close()
+
+    if len(decoded) != len(shard.records):
+        errors.append(
+            f"{shard.key}: {len(decoded)} records decoded, {len(shard.records)} expected"
+        )
+    for record, fields in zip(shard.records, decoded):
+        if fields["timestamp"] != record["date_time"]:
+            errors.append(
+                f"{record['date_time']}: timestamp decoded as {fields['timestamp']}"
             )
+        for key, field in fit_fields.items():
+            expected = record.get(key)
+            actual = fields[field]
+            # the encoder truncates to the resolution of the field
+            if (expected is None) != (actual is None) or (
+                expected is not None
+                and abs(actual - expected) > 1.0 / scales[field] + 1e-9
+            ):
+                errors.append(
+                    f"{record['date_time']}: {key}={expected} decoded as {field}={actual}"
+                )
+    return errors
 
-        fit_blood_pressure.finish()
-    else:
-        logging.info("No blood pressure data to sync for FIT file")
 
-    logging.debug("Fit data generated...")
-    return fit_weight, fit_blood_pressure
+def verify_fitshards(shards):
+    """Pass FIT shards on after a round-trip check against their records"""
+    for shard in shards:
+        errors = verify_fitshard(shard)
+        for error in errors:
+            logging.error("FIT verification: %s", error)
+        if errors:
+            raise FitVerificationError(f"FIT file {shard.key} does not match")
+        yield shard
 
 
 def generate_jsondata(syncdata):
@@ -274,85 +654,67 @@ def generate_jsondata(syncdata):
     return json_data
 
 
-def prepare_syncdata(height, groups):
-    """Prepare measurement data to be sent"""
-    syncdata = []
+def normalize_group(height, group, info=True, debug=False):
+    """Build the syncdata record of a measurement group
 
-    last_date_time = None
-    last_weight = None
+    Returns None for groups that are not synced: groups without weight
+    and, unless --features BLOOD_PRESSURE is set, without blood pressure."""
+    dt = group.get_datetime()
+    # decode all measures of the group in one pass
+    record = group.to_record()
 
-    sync_dict = {}
-
-    for group in groups:
-        # Get extra physical measurements
-        dt = group.get_datetime()
-        # create a default group_data
+    if record["weight"]:
+        weight = record["weight"]
+        hydration = record["hydration"]
         group_data = {
-            "date_time": group.get_datetime(),
-            "type": "None",
+            "date_time": dt,
+            "height": height,
+            "weight": weight,
+            "fat_ratio": record["fat_ratio"],
+            "muscle_mass": record["muscle_mass"],
+            "hydration": hydration,
+            "percent_hydration": (
+                round(hydration * 100.0 / weight, 2) if hydration else None
+            ),
+            "bone_mass": record["bone_mass"],
+            "pulse_wave_velocity": record["pulse_wave_velocity"],
+            "heart_pulse": record["heart_pulse"],
+            "bmi": round(weight / pow(height, 2), 1) if height else None,
+            "device_id": group.deviceid,
             "raw_data": group.get_raw_data(),
+            "type": "weight",
         }
-
-        if dt not in sync_dict:
-            sync_dict[dt] = {}
-
-        if group.get_weight():
-            group_data = {
-                "date_time": group.get_datetime(),
-                "height": height,
-                "weight": group.get_weight(),
-                "fat_ratio": group.get_fat_ratio(),
-                "muscle_mass": group.get_muscle_mass(),
-                "hydration": group.get_hydration(),
-                "percent_hydration": None,
-                "bone_mass": group.get_bone_mass(),
-                "pulse_wave_velocity": group.get_pulse_wave_velocity(),
-                "heart_pulse": group.get_heart_pulse(),
-                "bmi": None,
-                "raw_data": group.get_raw_data(),
-                "type": "weight",
-            }
-        elif group.get_diastolic_blood_pressure():
-            group_data = {
-                "date_time": group.get_datetime(),
-                "diastolic_blood_pressure": group.get_diastolic_blood_pressure(),
-                "systolic_blood_pressure": group.get_systolic_blood_pressure(),
-                "heart_pulse": group.get_heart_pulse(),
-                "raw_data": group.get_raw_data(),
-                "type": "blood_pressure",
-            }
-
-        # execute the code below, if this is not a whitelisted entry like weight and blood pressure
-        if group_data["type"] == "None" or (
-            group_data["type"] == "blood_pressure"
-            and "BLOOD_PRESSURE" not in ARGS.features
-        ):
-            collected_metrics = "weight data"
-            if "BLOOD_PRESSURE" in ARGS.features:
-                collected_metrics += " or blood pressure"
-            elif "diastolic_blood_pressure" in group_data:
-                collected_metrics += ", but blood pressure (to enable sync set --features BLOOD_PRESSURE)"
-
+    elif record["diastolic_blood_pressure"] and "BLOOD_PRESSURE" in ARGS.features:
+        group_data = {
+            "date_time": dt,
+            "diastolic_blood_pressure": record["diastolic_blood_pressure"],
+            "systolic_blood_pressure": record["systolic_blood_pressure"],
+            "heart_pulse": record["heart_pulse"],
+            "device_id": group.deviceid,
+            "raw_data": group.get_raw_data(),
+            "type": "blood_pressure",
+        }
+    else:
+        # not a whitelisted entry like weight and blood pressure
+        collected_metrics = "weight data"
+        if "BLOOD_PRESSURE" in ARGS.features:
+            collected_metrics += " or blood pressure"
+        elif record["diastolic_blood_pressure"]:
+            collected_metrics += ", but blood pressure (to enable sync set --features BLOOD_PRESSURE)"
+
+        if info:
             logging.info(
                 "%s This Withings metric contains no %s.  Not syncing...",
                 dt,
                 collected_metrics,
             )
-            groupdata_log_raw_data(group_data)
-            # Do not delete existing data for this timestamp; there may be valid
-            # weight or blood pressure measurements in other groups with the same timestamp.
-            # Simply skip this non-whitelisted group.
-            continue
+        if debug:
+            groupdata_log_raw_data({"raw_data": group.get_raw_data()})
+        return None
 
-        if height and "weight" in group_data:
-            group_data["bmi"] = round(
-                group_data["weight"] / pow(group_data["height"], 2), 1
-            )
-        if "hydration" in group_data and group_data["hydration"]:
-            group_data["percent_hydration"] = round(
-                group_data["hydration"] * 100.0 / group_data["weight"], 2
-            )
+    if info:
         logging.info("%s This Withings metric contains valid data. Syncing...", dt)
+    if debug:
         logging.debug("%s Detected data: ", dt)
         groupdata_log_raw_data(group_data)
         if "weight" in group_data:
@@ -375,7 +737,7 @@ def prepare_syncdata(height, groups):
                 group_data["bone_mass"],
                 group_data["bmi"],
             )
-        if "diastolic_blood_pressure" in group_data:
+        else:
             logging.debug(
                 "Record: %s, type=%s\n"
                 "diastolic_blood_pressure=%s mmHg, "
@@ -387,59 +749,111 @@ def prepare_syncdata(height, groups):
                 group_data["systolic_blood_pressure"],
                 group_data["heart_pulse"],
             )
+    return group_data
 
-        # join groups with same timestamp
-        # Merge without letting a later non-weight/bp group override an existing valid record
-        existing = sync_dict[dt]
-        # merge raw_data lists for richer JSON/debug output
-        if "raw_data" in group_data:
-            existing.setdefault("raw_data", [])
-            existing["raw_data"].extend(group_data["raw_data"])
-
-        # decide resulting type: prefer weight when present
-        if "type" not in existing or existing["type"] == "None":
-            existing["type"] = group_data["type"]
-        elif existing["type"] == "weight" and group_data["type"] != "weight":
-            # keep weight; do not downgrade to another type
-            pass
-        elif existing["type"] != "weight":
-            # allow switching from non-weight to the new type (e.g., blood_pressure)
-            existing["type"] = group_data["type"]
-
-        # merge scalar fields; keep existing non-None values
-        for k, v in group_data.items():
-            if k in ("type", "raw_data"):
-                continue
-            if v is not None:
-                existing[k] = v
-
-    last_measurement_type = None
-
-    # Iterate in chronological order for determinism
-    for dt in sorted(sync_dict.keys()):
-        group_data = sync_dict[dt]
-        # Skip empty or non-whitelisted groups (those that never collected a valid type)
-        if not group_data or "type" not in group_data or group_data["type"] == "None":
-            logging.debug("skipping data with timestamp: %s, type: %s", dt, group_data.get("type") if group_data else "empty")
-            if group_data:
-                # Log the group_data as JSON (excluding raw_data objects)
-                debug_data = {k: v for k, v in group_data.items() if k != "raw_data"}
-                logging.debug("skipped record details: %s", json.dumps(debug_data, indent=2, default=str))
+
+def merge_group_data(existing, group_data):
+    """Merge the record of another group with the same timestamp"""
+    # merge raw_data lists for richer JSON/debug output
+    existing["raw_data"].extend(group_data["raw_data"])
+    # prefer weight when present; do not downgrade to another type
+    if existing["type"] != "weight":
+        existing["type"] = group_data["type"]
+    # merge scalar fields; keep existing values a group does not have
+    for key, value in group_data.items():
+        if value is not None and key != "type" and key != "raw_data":
+            existing[key] = value
+
+
+def prepare_syncdata(height, groups):
+    """Prepare measurement data to be sent
+
+    Returns the type and time of the latest record and all records,
+    oldest first."""
+    syncdata = list(iter_syncdata(height, groups))
+    if not syncdata:
+        return None, None, syncdata
+    last = max(syncdata, key=lambda record: record["date_time"])
+    return last["type"], last["date_time"], syncdata
+
+
+def iter_syncdata(height, groups):
+    """Normalization stage, yields one syncdata record per timestamp
+
+    Groups with the same timestamp are merged into one record. Withings
+    returns the groups in date order, so these groups are adjacent and a
+    record is complete once a group with another timestamp comes in; a
+    single pass without sorting or keeping the records around.
+
+    Records are yielded oldest first. When the groups come newest first,
+    the records are kept and yielded in reverse once all are merged."""
+    # formatting log messages of every group is costly, only do it when logged
+    info = logging.getLogger().isEnabledFor(logging.INFO)
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    merged = None
+    merged_date = None
+    direction = 0
+    unordered = False
+    synced = False
+    # records of newest first groups, yielded at the end
+    pending = []
+
+    def complete():
+        """log the record of merged_date, None if none of its groups is synced"""
+        if merged is None:
+            if debug:
+                logging.debug(
+                    "skipping data with timestamp: %s, type: empty",
+                    datetime.fromtimestamp(merged_date),
+                )
+        elif debug:
+            logging.debug("Processed data: ")
+            for k, v in merged.items():
+                logging.debug("%s=%s", k, v)
+        return merged
+
+    for group in groups:
+        if group.date != merged_date:
+            if merged_date is not None:
+                step = 1 if group.date > merged_date else -1
+                if not direction:
+                    direction = step
+                elif step != direction and not unordered:
+                    unordered = True
+                    logging.warning(
+                        "Withings measurements are not in date order, "
+                        "measurements of the same time may not be merged"
+                    )
+                if complete() is not None:
+                    synced = True
+                    if direction < 0:
+                        pending.append(merged)
+                    else:
+                        yield merged
+            merged = None
+            merged_date = group.date
+
+        group_data = normalize_group(height, group, info, debug)
+        if group_data is None:
             continue
-        syncdata.append(group_data)
-        logging.debug("Processed data: ")
-        for k, v in group_data.items():
-            logging.debug("%s=%s", k, v)
-        if last_date_time is None or group_data["date_time"] > last_date_time:
-            last_date_time = group_data["date_time"]
-            last_measurement_type = group_data["type"]
-            logging.debug("last_dt: %s last_weight: %s", last_date_time, last_weight)
-
-    if last_measurement_type is None:
+        if merged is None:
+            merged = {"raw_data": [], "type": group_data["type"]}
+        merge_group_data(merged, group_data)
+
+    if merged_date is not None and complete() is not None:
+        synced = True
+        if direction < 0:
+            pending.append(merged)
+        else:
+            yield merged
+    if unordered:
+        pending.sort(key=lambda record: record["date_time"])
+    else:
+        pending.reverse()
+    yield from pending
+    if not synced:
         logging.error("Invalid or no data detected")
 
-    return last_measurement_type, last_date_time, syncdata
-
 
 def groupdata_log_raw_data(groupdata):
     """Logs raw data to debug"""
@@ -470,80 +884,271 @@ def write_withings_raw_json(filename, raw_json):
         logging.error("Unable to open output jsonfile! %s", filename)
 
 
-def write_to_fitfile(filename, fit_data):
-    """Writes fit data to fit file"""
+def open_fitfile(kind):
+    """Open the output fit file the encoder streams to"""
+    filename = f"{ARGS.output}.{kind}.fit"
     logging.info("Writing fitfile to %s.", filename)
     try:
-        with open(filename, "wb") as fitfile:
-            fitfile.write(fit_data.getvalue())
+        return open(filename, "w+b")
     except OSError:
         logging.error("Unable to open output fitfile! %s", filename)
+        return None
 
 
-def write_to_file_when_needed(fit_data_weigth, fit_data_blood_pressure, json_data):
+def write_to_file_when_needed(json_data):
     """Write measurements to file when requested"""
-    if ARGS.output is not None:
-        if ARGS.to_fit:
-            if fit_data_weigth is not None:
-                write_to_fitfile(ARGS.output + ".weight.fit", fit_data_weigth)
-            if fit_data_blood_pressure is not None:
-                write_to_fitfile(
-                    ARGS.output + ".blood_pressure.fit", fit_data_blood_pressure
-                )
-
-        if ARGS.to_json:
-            filename = ARGS.output + ".json"
-            logging.info("Writing jsonfile to %s.", filename)
-            try:
-                with open(filename, "w", encoding="utf-8") as jsonfile:
-                    json.dump(json_data, jsonfile, indent=4)
-            except OSError:
-                logging.error("Unable to open output jsonfile!")
+    # FIT files are streamed to their output file by iter_fitshards
+    if ARGS.output is not None and ARGS.to_json:
+        filename = ARGS.output + ".json"
+        logging.info("Writing jsonfile to %s.", filename)
+        try:
+            with open(filename, "w", encoding="utf-8") as jsonfile:
+                json.dump(json_data, jsonfile, indent=4)
+        except OSError:
+            logging.error("Unable to open output jsonfile!")
 
 
-def sync():
-    """Sync measurements from Withings to Garmin a/o TrainerRoad"""
-    # Prepare config folder
+def get_config_folder():
+    """Prepare the config folder, None if not specified"""
     config_folder = None
     if ARGS.config_folder:
         config_folder = os.path.abspath(os.path.expanduser(ARGS.config_folder))
         # Create directory if it doesn't exist
         os.makedirs(config_folder, exist_ok=True)
+    return config_folder
 
-    # Withings API
-    withings = WithingsAccount(config_folder=config_folder)
 
-    if not ARGS.fromdate:
+def get_sync_period(withings, window=None):
+    """Determine what to fetch
+
+    Returns startdate, enddate and lastupdate for the Withings requests and
+    whether the sync is incremental or over a fixed (ranged) period."""
+    ranged = ARGS.fromdate or window is not None
+    incremental = ARGS.incremental and not ranged
+    lastupdate = None
+
+    if incremental:
         if ARGS.trainerroad_username and ARGS.garmin_username:
-            startdate = min(withings.get_lastsync(), withings.get_lastsync_tr())
-        elif ARGS.garmin_username:
-            startdate = withings.get_lastsync()
+            lastupdate = min(withings.get_lastupdate(), withings.get_lastupdate_tr())
         elif ARGS.trainerroad_username:
-            startdate = withings.get_lastsync_tr()
+            lastupdate = withings.get_lastupdate_tr()
+        else:
+            lastupdate = withings.get_lastupdate()
+        startdate = lastupdate
+        enddate = int(time.time())
+        logging.info(
+            "Fetching measurements created or modified since %s",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(lastupdate)),
+        )
+    elif window is not None:
+        startdate, enddate = window
+        logging.info(
+            "Fetching notified measurements from %s to %s",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(startdate)),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(enddate)),
+        )
+    else:
+        if not ARGS.fromdate:
+            if ARGS.trainerroad_username and ARGS.garmin_username:
+                startdate = min(withings.get_lastsync(), withings.get_lastsync_tr())
+            elif ARGS.garmin_username:
+                startdate = withings.get_lastsync()
+            elif ARGS.trainerroad_username:
+                startdate = withings.get_lastsync_tr()
+            else:
+                startdate = withings.get_lastsync()
         else:
-            startdate = withings.get_lastsync()
+            startdate = int(time.mktime(ARGS.fromdate.timetuple()))
+
+        todate = ARGS.todate or date.today()
+        enddate = int(time.mktime(todate.timetuple())) + 86399
+        logging.info(
+            "Fetching measurements from %s to %s",
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(startdate)),
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(enddate)),
+        )
+
+    return startdate, enddate, lastupdate, incremental, ranged
+
+
+def start_fetch(sessions, startdate, enddate, lastupdate, incremental):
+    """Start the fetch stage of the pipeline"""
+    withings = sessions.withings
+    if sessions.store is not None:
+        # only fetch what the store is missing, then read the period from it
+        if not ARGS.offline:
+            withings.update_store(
+                startdate=None if incremental else startdate,
+                lastupdate=lastupdate,
+                workers=ARGS.backfill_workers,
+            )
+        groups = withings.iter_stored_measurements(
+            startdate=startdate, enddate=enddate, lastupdate=lastupdate
+        )
+    elif lastupdate is not None:
+        # Stream the groups page by page so that processing starts with the first page
+        groups = withings.iter_measurements(lastupdate=lastupdate)
     else:
-        startdate = int(time.mktime(ARGS.fromdate.timetuple()))
+        # long periods are fetched month by month, several months at once
+        groups = withings.iter_backfill(
+            startdate, enddate, workers=ARGS.backfill_workers
+        )
+    return Stage(groups, "fetch")
 
-    enddate = int(time.mktime(ARGS.todate.timetuple())) + 86399
-    logging.info(
-        "Fetching measurements from %s to %s",
-        time.strftime("%Y-%m-%d %H:%M", time.localtime(startdate)),
-        time.strftime("%Y-%m-%d %H:%M", time.localtime(enddate)),
-    )
 
-    height = withings.get_height()
-    groups = withings.get_measurements(startdate=startdate, enddate=enddate)
+def run_pipeline(sessions, height, groups, ledger):
+    """Normalize, encode and upload the fetched groups
 
-    # Only upload if there are measurement returned
-    if groups is None or len(groups) == 0:
-        logging.error("No measurements to upload for date or period specified")
-        return -1
+    Every stage runs in its own thread. Returns the normalized records,
+    the FIT shards and the Garmin upload states per kind."""
+    syncdata = []
+    fit_data = []
+    states = {}
+    stages = []
 
-    last_measurement_type, last_date_time, syncdata = prepare_syncdata(height, groups)
+    try:
+        stages.append(Stage(iter_syncdata(height, groups), "normalize"))
+        fit_syncdata = collect(stages[0], syncdata)
+        if ledger is not None and not ARGS.reupload:
+            # only encode measurements Garmin Connect does not have yet
+            fit_syncdata = ledger.iter_new(fit_syncdata)
+        shards = iter_fitshards(
+            fit_syncdata,
+            open_sink=open_fitfile if ARGS.output is not None and ARGS.to_fit else None,
+            device_info=ARGS.fit_device_info,
+            max_records=ARGS.fit_max_records,
+            max_size=ARGS.fit_max_size,
+        )
+        if ARGS.verify_fit:
+            shards = verify_fitshards(shards)
+        stages.append(Stage(collect(shards, fit_data), "encode"))
+        shards = iter(stages[-1])
 
+        first_shard = next(shards, None)
+        if ledger is not None and first_shard is not None:
+            logging.debug("attempting to upload fit file...")
+            # a single Garmin instance for all uploads, logged in once
+            garmin = sessions.get_garmin()
+            states = sync_garmin_shards(
+                itertools.chain([first_shard], shards), garmin, sessions.withings, ledger
+            )
+        else:
+            for _ in shards:
+                pass
+    except (FitVerificationError, WithingsException):
+        for shard in fit_data:
+            shard.fit.close()
+        raise
+    finally:
+        for stage in stages:
+            stage.close()
+
+    if ledger is not None and ledger.skipped:
+        logging.info(
+            "%d measurements were uploaded to Garmin Connect before - skipped them",
+            ledger.skipped,
+        )
+    return syncdata, fit_data, states
+
+
+def get_last_weight(syncdata):
+    """Latest weight record, None if there is none"""
+    # get weight entries (in case of only blood_pressure)
+    only_weight_entries = list(filter(lambda x: (x["type"] == "weight"), syncdata))
+    if not only_weight_entries:
+        return None
+    # sort and get last weight
+    return sorted(only_weight_entries, key=lambda x: x["date_time"])[-1]
+
+
+def trainerroad_weight(withings, syncdata, incremental, ranged):
+    """The weight record to upload to TrainerRoad, None if there is none
+
+    In incremental mode an edited older measurement must not replace a
+    newer weight sent before, so only a weight measured after the last one
+    sent is returned. When there is nothing to send the TrainerRoad sync
+    state still advances, so that the next run does not fetch the same
+    measurements again."""
+    if not ARGS.trainerroad_username:
+        logging.info("No TrainerRoad username - skipping sync")
+        return None
+    last_weight_measurement = get_last_weight(syncdata)
+    if last_weight_measurement is None:
+        logging.info("No new weight measurement for TrainerRoad - skipping sync")
+        trainerroad_skipped(withings, incremental, ranged)
+        return None
+    measured = int(last_weight_measurement["date_time"].timestamp())
+    if incremental and measured <= withings.get_lastweight_tr():
+        logging.info(
+            "No weight measured after the last one sent to TrainerRoad - skipping sync"
+        )
+        trainerroad_skipped(withings, incremental, ranged)
+        return None
+    logging.info("Trainerroad username set -- attempting to sync")
+    logging.info(" Last weight %s", last_weight_measurement["weight"])
+    logging.info(" Measured %s", last_weight_measurement["date_time"])
+    return last_weight_measurement
+
+
+def update_trainerroad(sessions, syncdata, incremental, ranged):
+    """Upload the last weight to TrainerRoad"""
+    withings = sessions.withings
+    last_weight_measurement = trainerroad_weight(withings, syncdata, incremental, ranged)
+    if last_weight_measurement is None:
+        return
+    if sync_trainerroad(last_weight_measurement["weight"], sessions.get_trainerroad()):
+        trainerroad_done(withings, last_weight_measurement, incremental, ranged)
+
+
+def trainerroad_skipped(withings, incremental, ranged):
+    """Save the sync state when TrainerRoad had nothing to update"""
+    if incremental:
+        withings.set_lastupdate_tr(withings.last_modified)
+    elif not ranged:
+        withings.set_lastsync_tr()
+
+
+def trainerroad_done(withings, last_weight_measurement, incremental, ranged):
+    """Save the sync state after the TrainerRoad update"""
+    logging.info("TrainerRoad update done!")
+    lastweight = int(last_weight_measurement["date_time"].timestamp())
+    if incremental:
+        withings.set_lastupdate_tr(withings.last_modified, lastweight)
+    elif not ranged:
+        withings.set_lastsync_tr(lastweight)
+
+
+def finish_garmin(withings, states, ledger, incremental, ranged):
+    """Save the sync state after the Garmin uploads, False if some failed"""
+    if ARGS.garmin_username and states:
+        if not all(states.values()):
+            logging.error("Not all FIT files were uploaded - rerun to retry")
+            return False
+
+        # every shard made it, a rerun should upload everything again
+        withings.clear_uploaded_shards()
+        # Save this sync so we don't re-download the same data again (if no range has been specified)
+        if incremental:
+            withings.set_lastupdate(withings.last_modified)
+        elif not ranged:
+            withings.set_lastsync()
+    elif ARGS.garmin_username is None:
+        logging.info("No Garmin username - skipping sync")
+    elif ledger is not None and ledger.skipped:
+        logging.info("All measurements were uploaded to Garmin Connect before")
+        if incremental:
+            withings.set_lastupdate(withings.last_modified)
+        elif not ranged:
+            withings.set_lastsync()
+    else:
+        logging.info("No Garmin data selected - skipping sync")
+    return True
+
+
+def write_outputs(withings, syncdata, startdate, enddate):
+    """Write the --dump-raw and --to-json files"""
     # dump raw Withings JSON to a file
-    if ARGS.dump_raw and hasattr(withings, "last_measurements_json"):
+    if ARGS.dump_raw and withings.last_measurements_json is not None:
         if ARGS.output:
             raw_filename = ARGS.output + ".withings_raw.json"
         else:
@@ -553,70 +1158,261 @@ def sync():
             raw_filename = f"withings_raw_{start_s}_{end_s}.json"
         write_withings_raw_json(raw_filename, withings.last_measurements_json)
 
-    fit_data_weight, fit_data_blood_pressure = generate_fitdata(syncdata)
     json_data = generate_jsondata(syncdata)
+    write_to_file_when_needed(json_data)
+
+
+def open_sessions(sessions):
+    """Sessions for a sync() run, fresh ones if sessions is None"""
+    if sessions is None:
+        return SyncSessions(get_config_folder())
+    if not ARGS.offline:
+        # the access token may have expired since the previous run
+        sessions.withings.withings.refresh_accesstoken_if_needed()
+    return sessions
+
+
+def sync(sessions=None, window=None):
+    """Sync measurements from Withings to Garmin a/o TrainerRoad
+
+    sessions may be SyncSessions kept from a previous run, otherwise
+    fresh ones are created and closed at the end of the run. window is a
+    (startdate, enddate) pair to sync instead of the period since the last
+    sync, as for --fromdate.
+
+    Returns 0 after a sync, SYNC_NOTHING when there were no measurements
+    and SYNC_FAILED when fetching, encoding or uploading failed."""
+    own_sessions = sessions is None
+    sessions = open_sessions(sessions)
+    withings = sessions.withings
+    startdate, enddate, lastupdate, incremental, ranged = get_sync_period(
+        withings, window
+    )
+    ledger = None
 
-    write_to_file_when_needed(fit_data_weight, fit_data_blood_pressure, json_data)
+    def close(fit_data=()):
+        close_sync(fit_data, ledger, sessions if own_sessions else None)
 
-    if not ARGS.no_upload:
-        # get weight entries (in case of only blood_pressure)
-        only_weight_entries = list(filter(lambda x: (x["type"] == "weight"), syncdata))
-        last_weight_exists = len(only_weight_entries) > 0
-        # Upload to Trainer Road
-        if ARGS.trainerroad_username and last_weight_exists:
-            # sort and get last weight
-            last_weight_measurement = sorted(
-                only_weight_entries, key=lambda x: x["date_time"]
-            )[-1]
-            last_weight = last_weight_measurement["weight"]
-            logging.info("Trainerroad username set -- attempting to sync")
-            logging.info(" Last weight %s", last_weight)
-            logging.info(" Measured %s", last_date_time)
-            if sync_trainerroad(last_weight):
-                logging.info("TrainerRoad update done!")
-                if not ARGS.fromdate:
-                    withings.set_lastsync_tr()
-        else:
-            logging.info("No TrainerRoad username or a new measurement - skipping sync")
+    try:
+        # fetch -> normalize -> encode -> upload, each stage in its own thread
+        stage = start_fetch(sessions, startdate, enddate, lastupdate, incremental)
+    except WithingsException as ex:
+        logging.error("%s", ex)
+        close()
+        return SYNC_FAILED
+    groups = iter(stage)
+    try:
+        # the first page is fetched while the height is read
+        height = withings.get_height()
+    except BaseException:
+        stage.close()
+        close()
+        raise
+    try:
+        first_group = next(groups, None)
+    except WithingsException as ex:
+        logging.error("%s", ex)
+        close()
+        return SYNC_FAILED
 
-        # Upload to Garmin Connect
-        if ARGS.garmin_username and (
-            fit_data_weight is not None or fit_data_blood_pressure is not None
-        ):
-            logging.debug("attempting to upload fit file...")
+    # Only upload if there are measurement returned
+    if first_group is None:
+        logging.error("No measurements to upload for date or period specified")
+        close()
+        return SYNC_NOTHING
+    groups = itertools.chain([first_group], groups)
 
-            # Create and authenticate a single Garmin instance for all uploads
-            garmin = GarminConnect(config_folder=config_folder)
-            garmin.login(ARGS.garmin_username, ARGS.garmin_password)
+    if ARGS.garmin_username and not ARGS.no_upload:
+        ledger = UploadLedger(LEDGER_FIELDS, sessions.config_folder)
+    try:
+        syncdata, fit_data, states = run_pipeline(sessions, height, groups, ledger)
+    except FitVerificationError:
+        logging.error("Generated FIT data does not match the measurements - stopped uploading")
+        close()
+        return SYNC_FAILED
+    except WithingsException as ex:
+        # a later page failed, the next run fetches the period again
+        logging.error("%s", ex)
+        close()
+        return SYNC_FAILED
+
+    write_outputs(withings, syncdata, startdate, enddate)
 
-            gar_wg_state = None
-            gar_bp_state = None
-            if fit_data_weight is not None:
-                gar_wg_state = sync_garmin(fit_data_weight, garmin=garmin)
-                if gar_wg_state:
-                    logging.info(
-                        "Fit file with weight information uploaded to Garmin Connect"
-                    )
-            if fit_data_blood_pressure is not None:
-                gar_bp_state = sync_garmin(fit_data_blood_pressure, garmin=garmin)
-                if gar_bp_state:
-                    logging.info(
-                        "Fit file with blood pressure information uploaded to Garmin Connect"
-                    )
-            if gar_wg_state or gar_bp_state:
-                # Save this sync so we don't re-download the same data again (if no range has been specified)
-                if not ARGS.fromdate:
-                    withings.set_lastsync()
-        elif ARGS.garmin_username is None:
-            logging.info("No Garmin username - skipping sync")
-        else:
-            logging.info("No Garmin data selected - skipping sync")
+    if not ARGS.no_upload:
+        update_trainerroad(sessions, syncdata, incremental, ranged)
+
+        # Uploads to Garmin Connect ran in the pipeline
+        if not finish_garmin(withings, states, ledger, incremental, ranged):
+            close(fit_data)
+            return SYNC_FAILED
     else:
         logging.info("Skipping upload")
+
+    close(fit_data)
     return 0
 
 
+def close_sync(fit_data, ledger, sessions):
+    """Release what a sync() run opened"""
+    for shard in fit_data:
+        shard.fit.close()
+    if ledger is not None:
+        ledger.close()
+    if sessions is not None:
+        sessions.close()
+
+
+def subscribe_notifications(withings, callbackurl):
+    """Subscribe callbackurl to the Withings notifications of synced data"""
+    withings.subscribe(callbackurl, NOTIFY_APPLI_WEIGHT)
+    if "BLOOD_PRESSURE" in ARGS.features:
+        withings.subscribe(callbackurl, NOTIFY_APPLI_BLOOD_PRESSURE)
+
+
+def daemon():
+    """Sync until SIGTERM or SIGINT
+
+    With --daemon a sync runs every --interval seconds, with --listen
+    whenever Withings notifies new measurements."""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    sessions = SyncSessions(get_config_folder())
+
+    receiver = None
+    if ARGS.listen:
+        host, _, port = ARGS.listen.rpartition(":")
+
+        def sync_window(startdate, enddate):
+            with sessions.lock:
+                try:
+                    sync(sessions, window=(startdate, enddate))
+                except Exception:
+                    sessions.reset()
+                    raise
+
+        if not ARGS.notify_token:
+            logging.warning(
+                "No --notify-token set, anyone reaching %s can trigger syncs", ARGS.listen
+            )
+        receiver = NotificationReceiver(
+            sync_window, host=host, port=int(port), token=ARGS.notify_token
+        )
+        receiver.start()
+        if ARGS.notify_url:
+            subscribe_notifications(
+                sessions.withings, callback_url(ARGS.notify_url, ARGS.notify_token)
+            )
+
+    failures = 0
+    while ARGS.daemon and not stop.is_set():
+        try:
+            with sessions.lock:
+                failed = sync(sessions) == SYNC_FAILED
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Sync failed")
+            failed = True
+        if failed:
+            failures += 1
+            sessions.reset()
+            # exponential backoff with full jitter, never beyond the interval
+            delay = min(ARGS.interval, DAEMON_BACKOFF * 2 ** (failures - 1))
+            delay = random.uniform(delay / 2, delay)
+        else:
+            failures = 0
+            delay = ARGS.interval
+        logging.info("Next sync in %d seconds", delay)
+        stop.wait(delay)
+    stop.wait()
+
+    logging.info("Stopping")
+    if receiver is not None:
+        receiver.stop()
+    sessions.close()
+
+
+def setup_logging(log_level):
+    """Log to stdout"""
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        stream=sys.stdout,
+    )
+
+
+def load_accounts(path):
+    """Read the account profiles of --accounts"""
+    with open(path, encoding="utf-8") as roster:
+        profiles = json.load(roster)
+    for profile in profiles:
+        unknown = set(profile) - set(ACCOUNT_SETTINGS + ACCOUNT_CREDENTIALS) - {"name"}
+        if unknown:
+            raise ValueError(f"Unknown account settings: {', '.join(sorted(unknown))}")
+        if not profile.get("config_folder"):
+            raise ValueError("Every account needs its own config_folder")
+    return profiles
+
+
+def init_account_worker(log_level, base_settings):
+    """Set up logging and the command line settings in a process syncing accounts"""
+    global BASE_SETTINGS  # pylint: disable=global-statement
+    setup_logging(log_level)
+    BASE_SETTINGS = base_settings
+
+
+def sync_account(profile):
+    """Sync one account profile, run in a worker process
+
+    The settings of the account are built from the command line ones, not
+    from those of the account the process synced before."""
+    global ARGS  # pylint: disable=global-statement
+    settings = BASE_SETTINGS | dict.fromkeys(ACCOUNT_CREDENTIALS) | profile
+    settings.pop("name", None)
+    ARGS = argparse.Namespace(**settings)
+    logging.info("Syncing account %s", profile.get("name", profile["config_folder"]))
+    return sync()
+
+
+def sync_accounts(profiles, log_level=logging.INFO):
+    """Sync several accounts concurrently
+
+    Every account runs in its own process, so that a failing account does
+    not affect the others. Returns the sync() result or the exception of
+    every account by name."""
+    results = {}
+    workers = max(1, min(ARGS.account_workers, len(profiles)))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_account_worker,
+        initargs=(log_level, dict(vars(ARGS))),
+    ) as pool:
+        futures = {
+            pool.submit(sync_account, profile): profile.get(
+                "name", profile["config_folder"]
+            )
+            for profile in profiles
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as ex:  # pylint: disable=broad-except
+                logging.error("Account %s failed: %s", name, ex)
+                results[name] = ex
+
+    for name, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            status = f"failed: {result}"
+        else:
+            status = {0: "synced", SYNC_FAILED: "failed"}.get(result, "nothing synced")
+        logging.info("Account %s: %s", name, status)
+    return results
+
+
 ARGS = get_args()
+# the command line settings accounts are synced with, see sync_account()
+BASE_SETTINGS = dict(vars(ARGS))
 
 
 def main():
@@ -628,11 +1424,7 @@ def main():
     else:
         log_level = logging.INFO
 
-    logging.basicConfig(
-        level=log_level,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        stream=sys.stdout,
-    )
+    setup_logging(log_level)
     logging.debug("withings-sync script version %s", version("withings-sync"))
     logging.debug("Script invoked with the following arguments: %s", ARGS)
 
@@ -640,4 +1432,9 @@ def main():
         print("Sorry, requires at least Python3.11.")
         sys.exit(1)
 
-    sync()
+    if ARGS.accounts:
+        sync_accounts(load_accounts(ARGS.accounts), log_level)
+    elif ARGS.daemon or ARGS.listen:
+        daemon()
+    else:
+        sync()
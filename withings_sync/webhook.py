@@ -0,0 +1,168 @@
+"""This module receives the Withings data update notifications."""
+import hmac
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit, urlunsplit
+
+log = logging.getLogger("webhook")
+
+# seconds without a further notification before a burst is synced, and the
+# longest a notification waits while more keep arriving
+COALESCE_DELAY = 5
+COALESCE_MAX_DELAY = 30
+
+
+def callback_url(url, token=None):
+    """url with the token a receiver expects added to its query"""
+    if not token:
+        return url
+    parts = urlsplit(url)
+    query = "&".join(filter(None, [parts.query, urlencode({"token": token})]))
+    return urlunsplit(parts._replace(query=query))
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    """Answer the Withings notify callbacks"""
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        # Withings checks that the callback URL answers before subscribing
+        self.send_response(200)
+        self.end_headers()
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.do_HEAD()
+
+    def authorized(self):
+        """whether the request carries the token of the receiver, if any"""
+        token = self.server.receiver.token
+        if not token:
+            return True
+        given = parse_qs(urlsplit(self.path).query).get("token", [""])[0]
+        return hmac.compare_digest(given.encode(), token.encode())
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if not self.authorized():
+            log.warning("Ignoring notification without a valid token")
+            self.send_response(403)
+            self.end_headers()
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        fields = parse_qs(self.rfile.read(length).decode("utf-8", "replace"))
+        try:
+            startdate = int(fields["startdate"][0])
+            enddate = int(fields["enddate"][0])
+        except (KeyError, ValueError):
+            log.warning("Ignoring malformed notification: %s", fields)
+            self.send_response(400)
+            self.end_headers()
+            return
+        # answer right away, Withings expects a quick response
+        self.send_response(200)
+        self.end_headers()
+        log.info(
+            "Notification for user %s, appli %s: %s to %s",
+            fields.get("userid", ["?"])[0],
+            fields.get("appli", ["?"])[0],
+            startdate,
+            enddate,
+        )
+        self.server.receiver.notify(startdate, enddate)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+class NotificationReceiver:
+    """HTTP endpoint that turns Withings notifications into syncs
+
+    Notified windows are merged until no notification arrived for delay
+    seconds (or max_delay passed), then handler(startdate, enddate) is
+    called once with the merged window from a single worker thread.
+    With a token, only notifications whose URL has it as token query
+    parameter are accepted."""
+
+    def __init__(
+        self,
+        handler,
+        host="",
+        port=8080,
+        delay=COALESCE_DELAY,
+        max_delay=COALESCE_MAX_DELAY,
+        token=None,
+    ):
+        self.handler = handler
+        self.token = token
+        self.delay = delay
+        self.max_delay = max_delay
+        self.cond = threading.Condition()
+        self.window = None
+        self.first = self.last = 0.0
+        self.stopping = False
+        self.server = ThreadingHTTPServer((host, port), NotificationHandler)
+        self.server.receiver = self
+        self.threads = []
+
+    @property
+    def address(self):
+        """(host, port) the receiver listens on"""
+        return self.server.server_address[:2]
+
+    def notify(self, startdate, enddate):
+        """queue a window, merging it with the ones not synced yet"""
+        with self.cond:
+            now = time.monotonic()
+            if self.window is None:
+                self.window = (startdate, enddate)
+                self.first = now
+            else:
+                self.window = (
+                    min(self.window[0], startdate),
+                    max(self.window[1], enddate),
+                )
+            self.last = now
+            self.cond.notify()
+
+    def _next_window(self):
+        """wait for a burst of notifications to settle and take its window"""
+        with self.cond:
+            while not self.stopping:
+                if self.window is None:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                due = min(self.last + self.delay, self.first + self.max_delay)
+                if now >= due:
+                    window, self.window = self.window, None
+                    return window
+                self.cond.wait(due - now)
+            return None
+
+    def _work(self):
+        while True:
+            window = self._next_window()
+            if window is None:
+                return
+            try:
+                self.handler(*window)
+            except Exception:  # pylint: disable=broad-except
+                log.exception("Sync of notified window %s to %s failed", *window)
+
+    def start(self):
+        """serve notifications in background threads"""
+        for target in (self.server.serve_forever, self._work):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        log.info("Listening for Withings notifications on %s:%s", *self.address)
+
+    def stop(self):
+        """stop serving, a running sync is finished first"""
+        self.server.shutdown()
+        self.server.server_close()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        for thread in self.threads:
+            thread.join()
@@ -3,9 +3,16 @@ from datetime import date, datetime
 import logging
 import json
 import os
+import threading
 import time
+import collections
 import importlib.resources
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from withings_sync.pipeline import RateLimiter
 
 log = logging.getLogger("withings")
 
@@ -13,6 +20,7 @@ HOME = os.environ.get("HOME", ".")
 AUTHORIZE_URL = "https://account.withings.com/oauth2_user/authorize2"
 TOKEN_URL = "https://wbsapi.withings.net/v2/oauth2"
 GETMEAS_URL = "https://wbsapi.withings.net/measure?action=getmeas"
+NOTIFY_URL = "https://wbsapi.withings.net/notify"
 
 
 APP_CONFIG = os.environ.get(
@@ -21,11 +29,63 @@ APP_CONFIG = os.environ.get(
 )
 USER_CONFIG = os.environ.get("WITHINGS_USER", HOME + "/.withings_user.json")
 
+HTTP_POOL_SIZE = int(os.environ.get("WITHINGS_HTTP_POOL_SIZE", 4))
+HTTP_TIMEOUT = float(os.environ.get("WITHINGS_HTTP_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("WITHINGS_HTTP_RETRIES", 3))
+
+# seconds a cached height is trusted before Withings is asked for updates
+HEIGHT_CACHE_TTL = int(os.environ.get("WITHINGS_HEIGHT_TTL", 7 * 86400))
+
+# refresh the access token when it expires within this many seconds
+TOKEN_REFRESH_MARGIN = 600
+# Withings API status for an invalid or expired access token
+STATUS_INVALID_TOKEN = 401
+
+# long periods are fetched in windows of this many calendar months, by
+# concurrent requests at least BACKFILL_INTERVAL seconds apart
+BACKFILL_MONTHS = int(os.environ.get("WITHINGS_BACKFILL_MONTHS", 12))
+BACKFILL_WORKERS = int(os.environ.get("WITHINGS_BACKFILL_WORKERS", 4))
+BACKFILL_INTERVAL = float(os.environ.get("WITHINGS_BACKFILL_INTERVAL", 0.5))
+
 
 class WithingsException(Exception):
     """Pass WithingsExceptions"""
 
 
+def plan_windows(startdate, enddate, months=BACKFILL_MONTHS):
+    """split [startdate, enddate] into windows ending at calendar month boundaries"""
+    windows = []
+    start = startdate
+    while start <= enddate:
+        day = datetime.fromtimestamp(start)
+        month = day.month - 1 + months
+        boundary = datetime(day.year + month // 12, month % 12 + 1, 1)
+        end = min(int(boundary.timestamp()) - 1, enddate)
+        windows.append((start, end))
+        start = end + 1
+    return windows
+
+
+def new_session(pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES):
+    """create a keep-alive session for the Withings API"""
+    # Read errors are not retried: a token request may already have been
+    # processed by Withings, which would invalidate the refresh token.
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
 class WithingsConfig:
     """This class takes care of the Withings config file"""
 
@@ -34,6 +94,8 @@ class WithingsConfig:
 
     def __init__(self, config_file):
         self.config_file = config_file
+        # sync steps running concurrently may save the config at the same time
+        self.lock = threading.Lock()
         self.read()
 
     def read(self):
@@ -47,8 +109,10 @@ class WithingsConfig:
 
     def write(self):
         """writes config file"""
-        with open(self.config_file, "w", encoding="utf8") as configfile:
-            json.dump(self.config, configfile, indent=4, sort_keys=True)
+        with self.lock:
+            config = dict(self.config)
+            with open(self.config_file, "w", encoding="utf8") as configfile:
+                json.dump(config, configfile, indent=4, sort_keys=True)
 
 
 class WithingsOAuth2:
@@ -56,7 +120,12 @@ class WithingsOAuth2:
 
     app_config = user_config = None
 
-    def __init__(self, config_folder=None):
+    def __init__(
+        self, config_folder=None, session=None, timeout=HTTP_TIMEOUT, authenticate=True
+    ):
+        self.session = session if session is not None else new_session()
+        self.timeout = timeout
+
         # Determine app config file path with fallback chain
         if config_folder:
             app_config_path = os.path.join(config_folder, "withings_app.json")
@@ -89,6 +158,10 @@ class WithingsOAuth2:
                 log.info(f"Using new config folder: {user_config_path}")
                 log.info(f"If you want to use existing credentials, copy from: {legacy_path}")
 
+        if not authenticate:
+            # offline use, only the user config is needed
+            return
+
         if not self.user_config.get("access_token"):
             if not self.user_config.get("authentification_code"):
                 self.user_config[
@@ -103,15 +176,39 @@ class WithingsOAuth2:
                 ] = self.get_authenticationcode()
                 self.get_accesstoken()
 
-
-        self.refresh_accesstoken()
-
-        self.user_cfg.write()
+        self.refresh_accesstoken_if_needed()
 
     def update_config(self):
         """updates config file"""
         self.user_cfg.write()
 
+    def token_expired(self):
+        """check whether the access token is expired or about to expire"""
+        # configs written by older versions carry no expiry: refresh once
+        expires_at = self.user_config.get("expires_at")
+        return not expires_at or time.time() > expires_at - TOKEN_REFRESH_MARGIN
+
+    def refresh_accesstoken_if_needed(self):
+        """refresh the access token only when it is near expiry"""
+        if self.token_expired():
+            self.refresh_accesstoken()
+        else:
+            log.debug("Access token still valid, skipping refresh")
+
+    def _store_token(self, body):
+        """store a token response in the user config and persist it"""
+        self.user_config["access_token"] = body.get("access_token")
+        self.user_config["refresh_token"] = body.get("refresh_token")
+        self.user_config["userid"] = body.get("userid")
+        self.user_config["expires_at"] = int(time.time()) + int(
+            body.get("expires_in", 0)
+        )
+        self.update_config()
+
+    def post(self, url, params):
+        """post a request to the Withings API over the shared session"""
+        return self.session.post(url, params, timeout=self.timeout)
+
     def get_authenticationcode(self):
         """get Withings authentication code"""
         params = {
@@ -159,7 +256,7 @@ class WithingsOAuth2:
             "redirect_uri": self.app_config["callback_url"],
         }
 
-        req = requests.post(TOKEN_URL, params)
+        req = self.post(TOKEN_URL, params)
         resp = req.json()
 
         status = resp.get("status")
@@ -178,9 +275,7 @@ class WithingsOAuth2:
             )
             raise
 
-        self.user_config["access_token"] = body.get("access_token")
-        self.user_config["refresh_token"] = body.get("refresh_token")
-        self.user_config["userid"] = body.get("userid")
+        self._store_token(body)
 
     def refresh_accesstoken(self):
         """refresh Withings access token"""
@@ -194,7 +289,7 @@ class WithingsOAuth2:
             "refresh_token": self.user_config["refresh_token"],
         }
 
-        req = requests.post(TOKEN_URL, params)
+        req = self.post(TOKEN_URL, params)
         resp = req.json()
 
         status = resp.get("status")
@@ -211,17 +306,28 @@ class WithingsOAuth2:
                 "If it's regarding an invalid code, try to start the"
                 " script again to obtain a new link."
             )
+            raise WithingsException(f"Could not refresh access token ({status})")
 
-        self.user_config["access_token"] = body.get("access_token")
-        self.user_config["refresh_token"] = body.get("refresh_token")
-        self.user_config["userid"] = body.get("userid")
+        self._store_token(body)
 
 
 class WithingsAccount:
     """This class gets measurements from Withings"""
 
-    def __init__(self, config_folder=None):
-        self.withings = WithingsOAuth2(config_folder=config_folder)
+    def __init__(
+        self, config_folder=None, session=None, keep_raw=False, store=None, offline=False
+    ):
+        self.withings = WithingsOAuth2(
+            config_folder=config_folder, session=session, authenticate=not offline
+        )
+        self.keep_raw = keep_raw
+        # optional MeasurementStore fetched measurements are written to
+        self.store = store
+        self.offline = offline
+        self.last_modified = None
+        self.last_measurements_json = None
+        # concurrent requests must not refresh the access token twice
+        self.token_lock = threading.Lock()
 
     def get_lastsync(self):
         """get last sync timestamp"""
@@ -241,81 +347,330 @@ class WithingsAccount:
             return int(time.mktime(date.today().timetuple()))
         return self.withings.user_config["last_sync_tr"]
 
-    def set_lastsync_tr(self):
+    def set_lastsync_tr(self, lastweight=None):
         """set last TrainerRoad sync timestamp"""
         self.withings.user_config["last_sync_tr"] = int(time.time())
+        if lastweight is not None:
+            self.withings.user_config["last_weight_tr"] = lastweight
         log.info("Saving Last TR Sync")
         self.withings.update_config()
 
-    def get_measurements(self, startdate, enddate):
-        """get Withings measurements"""
-        log.info("Get Measurements")
+    def get_lastupdate(self):
+        """get Garmin high-water mark of Withings modification time"""
+        return self.withings.user_config.get("last_update") or self.get_lastsync()
+
+    def set_lastupdate(self, lastupdate):
+        """set Garmin high-water mark of Withings modification time"""
+        self.withings.user_config["last_update"] = lastupdate
+        log.info("Saving Last Update")
+        self.withings.update_config()
 
+    def get_lastupdate_tr(self):
+        """get TrainerRoad high-water mark of Withings modification time"""
+        return self.withings.user_config.get("last_update_tr") or self.get_lastsync_tr()
+
+    def set_lastupdate_tr(self, lastupdate, lastweight=None):
+        """set TrainerRoad high-water mark of Withings modification time
+
+        lastweight is the measurement time of the weight sent along."""
+        self.withings.user_config["last_update_tr"] = lastupdate
+        if lastweight is not None:
+            self.withings.user_config["last_weight_tr"] = lastweight
+        log.info("Saving Last TR Update")
+        self.withings.update_config()
+
+    def get_lastweight_tr(self):
+        """get measurement time of the last weight sent to TrainerRoad"""
+        return self.withings.user_config.get("last_weight_tr", 0)
+
+    def get_uploaded_shards(self):
+        """get keys of FIT shards uploaded by an unfinished sync"""
+        return set(self.withings.user_config.get("uploaded_shards", []))
+
+    def add_uploaded_shard(self, key):
+        """record an uploaded FIT shard so a retry can skip it"""
+        self.withings.user_config.setdefault("uploaded_shards", []).append(key)
+        self.withings.update_config()
+
+    def clear_uploaded_shards(self):
+        """forget uploaded FIT shards once a sync has finished"""
+        if self.withings.user_config.pop("uploaded_shards", None) is not None:
+            self.withings.update_config()
+
+    def subscribe(self, callbackurl, appli):
+        """ask Withings to notify callbackurl about new data of category appli"""
         params = {
+            "action": "subscribe",
+            "callbackurl": callbackurl,
+            "appli": appli,
             "access_token": self.withings.user_config["access_token"],
+        }
+        response = self.withings.post(NOTIFY_URL, params).json()
+        status = response.get("status")
+        if status != 0:
+            raise WithingsException(
+                f"Received error code {status} while subscribing {callbackurl}"
+            )
+        log.info("Subscribed %s to Withings notifications (appli %s)", callbackurl, appli)
+
+    def _getmeas(self, params):
+        """post a getmeas request, refreshing a rejected access token once"""
+        params["access_token"] = self.withings.user_config["access_token"]
+        measurements = self.withings.post(GETMEAS_URL, params).json()
+
+        if measurements.get("status") == STATUS_INVALID_TOKEN:
+            with self.token_lock:
+                if params["access_token"] == self.withings.user_config["access_token"]:
+                    log.info("Access token rejected by Withings, refreshing")
+                    self.withings.refresh_accesstoken()
+            params["access_token"] = self.withings.user_config["access_token"]
+            measurements = self.withings.post(GETMEAS_URL, params).json()
+
+        return measurements
+
+    def _iter_pages(self, params, limiter=None):
+        """yield the responses of a getmeas request, following the paging offset"""
+        while True:
+            if limiter is not None:
+                limiter.wait()
+            measurements = self._getmeas(params)
+
+            status = measurements.get("status")
+            if status != 0:
+                raise WithingsException(
+                    f"Received error code {status} while fetching measurements"
+                )
+            yield measurements
+
+            # Withings pages large ranges; 'more' flags a further page
+            # starting at 'offset'
+            body = measurements.get("body")
+            if not body.get("more"):
+                return
+            params["offset"] = body.get("offset")
+            log.debug("Fetching next page of measurements at offset %s", params["offset"])
+
+    def iter_measurements(self, startdate=None, enddate=None, lastupdate=None):
+        """yield Withings measurement groups, following the paging offset
+
+        With lastupdate, only groups created or modified since then are
+        returned and the date window is ignored. The newest modification
+        time seen is kept in last_modified."""
+        log.info("Get Measurements")
+
+        params = {
             # 'meastype': MEASTYPE_WEIGHT,
             "category": 1,
-            "startdate": startdate,
-            "enddate": enddate,
         }
+        if lastupdate is not None:
+            params["lastupdate"] = lastupdate
+        else:
+            params["startdate"] = startdate
+            params["enddate"] = enddate
+        self.last_modified = lastupdate
+        self.last_measurements_json = [] if self.keep_raw else None
+
+        for measurements in self._iter_pages(params):
+            yield from self._received_groups(measurements)
+
+    def _received_groups(self, measurements):
+        """keep a getmeas response and yield its groups"""
+        if self.keep_raw:
+            self.last_measurements_json.append(measurements)
+
+        body = measurements.get("body")
+        log.debug("Measurements received")
+        if self.store is not None:
+            self.store.add_groups(body.get("measuregrps"))
+        for group in body.get("measuregrps"):
+            group = WithingsMeasureGroup(group)
+            if self.last_modified is None or group.modified > self.last_modified:
+                self.last_modified = group.modified
+            yield group
+
+    def fetch_window(self, startdate, enddate, limiter=None):
+        """get all getmeas responses of one date window"""
+        params = {"category": 1, "startdate": startdate, "enddate": enddate}
+        return list(self._iter_pages(params, limiter))
+
+    def iter_backfill(
+        self, startdate, enddate, workers=BACKFILL_WORKERS, interval=BACKFILL_INTERVAL
+    ):
+        """yield the Withings measurement groups of a long period, oldest first
+
+        The period is split into month windows that are fetched by up to
+        workers concurrent requests, at least interval seconds apart.
+        With a store, every stored window is checkpointed, so that an
+        interrupted backfill over the same period reads those windows
+        from the store instead of fetching them again."""
+        windows = plan_windows(startdate, enddate)
+        if len(windows) == 1 or workers <= 1:
+            yield from self.iter_measurements(startdate=startdate, enddate=enddate)
+            return
+
+        log.info("Get Measurements in %d windows", len(windows))
+        done = self.store.get_backfilled() if self.store is not None else set()
+        if done:
+            log.info("Resuming backfill, %d windows were fetched before", len(done))
+        limiter = RateLimiter(interval)
+        self.last_modified = None
+        self.last_measurements_json = [] if self.keep_raw else None
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # windows in date order, each with its running fetch or None if
+            # it is in the store already
+            pending = collections.deque()
+            running = 0
+            todo = iter(windows)
+            try:
+                while True:
+                    while running < workers:
+                        window = next(todo, None)
+                        if window is None:
+                            break
+                        if window in done:
+                            pending.append((window, None))
+                            continue
+                        pending.append(
+                            (window, pool.submit(self.fetch_window, *window, limiter))
+                        )
+                        running += 1
+                    if not pending:
+                        break
+
+                    window, future = pending.popleft()
+                    if future is None:
+                        for group in self.store.iter_groups(*window):
+                            if self.last_modified is None or group.modified > self.last_modified:
+                                self.last_modified = group.modified
+                            yield group
+                        continue
+
+                    running -= 1
+                    groups = []
+                    for measurements in future.result():
+                        groups.extend(self._received_groups(measurements))
+                    if self.store is not None:
+                        self.store.add_backfilled(*window)
+                    # merge chronologically whatever order Withings used
+                    groups.sort(key=lambda group: group.date)
+                    yield from groups
+            finally:
+                for _, future in pending:
+                    if future is not None:
+                        future.cancel()
+
+    def update_store(self, startdate=None, lastupdate=None, workers=BACKFILL_WORKERS):
+        """fetch the measurements the local store is missing
+
+        Groups created or modified since the previous fetch are always
+        fetched, groups dated from startdate on only when the store does
+        not cover that period yet. lastupdate is where a store that was
+        never filled starts fetching modified groups."""
+        checked = int(time.time())
+        since = self.store.get_state("since")
+        last_update = self.store.get_state("last_update") or lastupdate
+
+        if last_update is not None:
+            for _ in self.iter_measurements(lastupdate=last_update):
+                pass
+        if startdate is not None and (since is None or startdate < since):
+            enddate = since if since is not None else checked
+            for _ in self.iter_backfill(startdate, enddate, workers=workers):
+                pass
+            self.store.set_state("since", startdate)
+            self.store.clear_backfilled()
+        if last_update is not None or startdate is not None:
+            self.store.set_state("last_update", checked)
+
+    def iter_stored_measurements(self, startdate=None, enddate=None, lastupdate=None):
+        """yield measurement groups from the local store, like iter_measurements"""
+        self.last_modified = lastupdate
+        for group in self.store.iter_groups(startdate, enddate, lastupdate):
+            if self.last_modified is None or group.modified > self.last_modified:
+                self.last_modified = group.modified
+            yield group
 
-        req = requests.post(GETMEAS_URL, params)
-
-        measurements = req.json()
-
-        if measurements.get("status") == 0:
-            log.debug("Measurements received")
-            return [
-                WithingsMeasureGroup(g)
-                for g in measurements.get("body").get("measuregrps")
-            ]
-        return None
+    def get_measurements(self, startdate, enddate):
+        """get Withings measurements"""
+        try:
+            return list(self.iter_measurements(startdate, enddate))
+        except WithingsException as ex:
+            log.error("%s", ex)
+            return None
 
     def get_height(self):
-        """get height from Withings"""
-        height = None
-        height_timestamp = None
-        height_group = None
+        """get height, from the user config cache or from Withings"""
+        cache = self.withings.user_config.get("height_cache")
+        if self.offline:
+            if cache and cache["value"] is not None:
+                return cache["value"]
+            return self.store.get_latest(WithingsMeasure.TYPE_HEIGHT)
+        if cache and time.time() - cache["checked"] < HEIGHT_CACHE_TTL:
+            log.debug("Using cached height %s", cache["value"])
+            return cache["value"]
 
         log.debug("Get Height")
 
         params = {
-            "access_token": self.withings.user_config["access_token"],
             "meastype": WithingsMeasure.TYPE_HEIGHT,
             "category": 1,
         }
+        if cache:
+            # only ask for height records created or changed since last check
+            params["lastupdate"] = cache["checked"]
+
+        checked = int(time.time())
+        measurements = self._getmeas(params)
+
+        if measurements.get("status") != 0:
+            return cache["value"] if cache else None
+
+        log.debug("Height received")
+        if not cache:
+            cache = {"value": None, "date": 0}
+
+        # there could be multiple height records. use the latest one
+        for record in measurements.get("body").get("measuregrps"):
+            height_group = WithingsMeasureGroup(record)
+            height = height_group.get_height()
+            if height is not None and height_group.date >= cache["date"]:
+                cache["value"] = height
+                cache["date"] = height_group.date
+
+        cache["checked"] = checked
+        self.withings.user_config["height_cache"] = cache
+        self.withings.update_config()
 
-        req = requests.post(GETMEAS_URL, params)
-
-        measurements = req.json()
-
-        if measurements.get("status") == 0:
-            log.debug("Height received")
-
-            # there could be multiple height records. use the latest one
-            for record in measurements.get("body").get("measuregrps"):
-                height_group = WithingsMeasureGroup(record)
-                if height is not None:
-                    if height_timestamp is not None:
-                        if height_group.get_datetime() > height_timestamp:
-                            height = height_group.get_height()
-                else:
-                    height = height_group.get_height()
-                    height_timestamp = height_group.get_datetime()
-
-        return height
+        return cache["value"]
 
 
 class WithingsMeasureGroup:
     """This class takes care of the group measurement functions"""
 
+    __slots__ = (
+        "grpid",
+        "attrib",
+        "date",
+        "category",
+        "modified",
+        "deviceid",
+        "measures",
+        "_by_type",
+    )
+
     def __init__(self, measuregrp):
-        self._raw_data = measuregrp
         self.grpid = measuregrp.get("grpid")
         self.attrib = measuregrp.get("attrib")
         self.date = measuregrp.get("date")
         self.category = measuregrp.get("category")
-        self.measures = [WithingsMeasure(m) for m in measuregrp["measures"]]
+        self.modified = measuregrp.get("modified", self.date)
+        self.deviceid = measuregrp.get("hash_deviceid") or measuregrp.get("deviceid")
+        self.measures = tuple(WithingsMeasure(m) for m in measuregrp["measures"])
+        # index by type once; the first measure of a type wins, as before
+        self._by_type = {}
+        for measure in self.measures:
+            self._by_type.setdefault(measure.type, measure)
 
     def __iter__(self):
         for measure in self.measures:
@@ -332,117 +687,86 @@ class WithingsMeasureGroup:
         """convenient function to get raw data"""
         return self.measures
 
+    def _get_value(self, meastype):
+        """get the rounded value of the given measure type"""
+        measure = self._by_type.get(meastype)
+        if measure is None:
+            return None
+        return round(measure.get_value(), 2)
+
+    def to_record(self):
+        """decode every known measure type in one pass"""
+        record_fields = WithingsMeasure.record_fields
+        record = dict.fromkeys(record_fields.values())
+        for meastype, measure in self._by_type.items():
+            field = record_fields.get(meastype)
+            if field is not None:
+                record[field] = round(measure.get_value(), 2)
+        return record
+
     def get_weight(self):
         """convenient function to get weight"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_WEIGHT:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_WEIGHT)
 
     def get_height(self):
         """convenient function to get height"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HEIGHT:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_HEIGHT)
 
     def get_fat_free_mass(self):
         """convenient function to get fat free mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_FREE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_FAT_FREE_MASS)
 
     def get_fat_ratio(self):
         """convenient function to get fat ratio"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_RATIO:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_FAT_RATIO)
 
     def get_fat_mass_weight(self):
         """convenient function to get fat mass weight"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_FAT_MASS_WEIGHT:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_FAT_MASS_WEIGHT)
 
     def get_diastolic_blood_pressure(self):
         """convenient function to get diastolic blood pressure"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_DIASTOLIC_BLOOD_PRESSURE)
 
     def get_systolic_blood_pressure(self):
         """convenient function to get systolic blood pressure"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_SYSTOLIC_BLOOD_PRESSURE)
 
     def get_heart_pulse(self):
         """convenient function to get heart pulse"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HEART_PULSE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_HEART_PULSE)
 
     def get_temperature(self):
         """convenient function to get temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_TEMPERATURE)
 
     def get_sp02(self):
         """convenient function to get sp02"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SP02:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_SP02)
 
     def get_body_temperature(self):
         """convenient function to get body temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_BODY_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_BODY_TEMPERATURE)
 
     def get_skin_temperature(self):
         """convenient function to get skin temperature"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_SKIN_TEMPERATURE:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_SKIN_TEMPERATURE)
 
     def get_muscle_mass(self):
         """convenient function to get muscle mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_MUSCLE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_MUSCLE_MASS)
 
     def get_hydration(self):
         """convenient function to get hydration"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_HYDRATION:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_HYDRATION)
 
     def get_bone_mass(self):
         """convenient function to get bone mass"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_BONE_MASS:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_BONE_MASS)
 
     def get_pulse_wave_velocity(self):
         """convenient function to get pulse wave velocity"""
-        for measure in self.measures:
-            if measure.type == WithingsMeasure.TYPE_PULSE_WAVE_VELOCITY:
-                return round(measure.get_value(), 2)
-        return None
+        return self._get_value(WithingsMeasure.TYPE_PULSE_WAVE_VELOCITY)
 
 
 class WithingsMeasure:
@@ -522,13 +846,42 @@ class WithingsMeasure:
         TYPE_ELECTRODERMAL_ACTIVITY_RIGHT_FOOT: ["Electrodermal activity right foot", ""],
     }
 
+    # field names used by WithingsMeasureGroup.to_record
+    record_fields = {
+        TYPE_WEIGHT: "weight",
+        TYPE_HEIGHT: "height",
+        TYPE_FAT_FREE_MASS: "fat_free_mass",
+        TYPE_FAT_RATIO: "fat_ratio",
+        TYPE_FAT_MASS_WEIGHT: "fat_mass_weight",
+        TYPE_DIASTOLIC_BLOOD_PRESSURE: "diastolic_blood_pressure",
+        TYPE_SYSTOLIC_BLOOD_PRESSURE: "systolic_blood_pressure",
+        TYPE_HEART_PULSE: "heart_pulse",
+        TYPE_TEMPERATURE: "temperature",
+        TYPE_SP02: "sp02",
+        TYPE_BODY_TEMPERATURE: "body_temperature",
+        TYPE_SKIN_TEMPERATURE: "skin_temperature",
+        TYPE_MUSCLE_MASS: "muscle_mass",
+        TYPE_HYDRATION: "hydration",
+        TYPE_BONE_MASS: "bone_mass",
+        TYPE_PULSE_WAVE_VELOCITY: "pulse_wave_velocity",
+    }
+
+    __slots__ = ("value", "type", "unit")
+
     def __init__(self, measure):
-        self._raw_data = measure
         self.value = measure.get("value")
         self.type = measure.get("type")
         self.unit = measure.get("unit")
-        self.type_s = self.withings_table.get(self.type, ["unknown", ""])[0]
-        self.unit_s = self.withings_table.get(self.type, ["unknown", ""])[1]
+
+    @property
+    def type_s(self):
+        """label of the measure type"""
+        return self.withings_table.get(self.type, ["unknown", ""])[0]
+
+    @property
+    def unit_s(self):
+        """label of the measure unit"""
+        return self.withings_table.get(self.type, ["unknown", ""])[1]
 
     def __str__(self):
         return f"{self.type_s}: {self.get_value()} {self.unit_s}"
@@ -539,3 +892,4 @@ class WithingsMeasure:
     def get_value(self):
         """get value"""
         return self.value * pow(10, self.unit)
+